@@ -0,0 +1,63 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+"""
+The current group, country and party of the MEPs, denormalized on MEP from
+their latest GroupMEP and CountryMEP.
+"""
+
+from parltrack_meps.models import MEP, GroupMEP, CountryMEP
+
+# period model -> the fields copied from its latest row as MEP.current_<field>
+CURRENT_AFFILIATIONS = (
+    (GroupMEP, ("group",)),
+    (CountryMEP, ("country", "party")),
+)
+
+
+def latest_period(periods, fields):
+    "The period ending last, ties broken by begin then the ids of fields"
+    return max(periods, key=lambda period: (period.end, period.begin) +
+               tuple(getattr(period, "%s_id" % field) for field in fields))
+
+
+def current_affiliations(periods, fields):
+    "MEP.current_<field> ids given all the periods of a MEP"
+    period = latest_period(periods, fields) if periods else None
+    return dict(("current_%s" % field, getattr(period, "%s_id" % field) if period else None)
+                for field in fields)
+
+
+def save_current_affiliations(meps, values):
+    """
+    Set values (MEP pk -> {current_<field>: id}) on the MEPs of meps (pk ->
+    MEP) they differ from, with one UPDATE per distinct column value, and
+    return the number of MEPs changed.
+    """
+    changed = {}
+    for pk, columns in values.items():
+        mep = meps[pk]
+        for column, value in columns.items():
+            if getattr(mep, "%s_id" % column) != value:
+                setattr(mep, "%s_id" % column, value)
+                changed.setdefault((column, value), []).append(pk)
+
+    for (column, value), pks in changed.items():
+        for i in range(0, len(pks), 500):
+            MEP.objects.filter(pk__in=pks[i:i + 500]).update(**{column: value})
+    return len(set(pk for pks in changed.values() for pk in pks))
@@ -16,10 +16,27 @@
 #
 # Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
 
+import time
+import hashlib
+import calendar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.conf.urls import url
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.csrf import csrf_exempt
+from django.db.models import ForeignKey
+from django.db.models.fields import FieldDoesNotExist
 from tastypie import fields
+from tastypie.exceptions import BadRequest
 from tastypie.resources import ModelResource
+# every queryset selects or prefetches what its fields use, so a list page
+# costs the same number of queries whatever its size
 from parltrack_meps.models import Country,\
-                                LocalParty,\
+                                Party,\
                                 Group,\
                                 Delegation,\
                                 Committee,\
@@ -31,112 +48,357 @@ from parltrack_meps.models import Country,\
                                 CommitteeRole,\
                                 PostalAddress,\
                                 CountryMEP,\
-                                OrganizationMEP
-
-
-class MEPCountryResource(ModelResource):
+                                OrganizationMEP,\
+                                ImportCheckpoint
+from parltrack_meps.export import EXPORT_FORMATS, export_records
+from parltrack_meps.pagination import KeysetPaginator, PeriodKeysetPaginator
+
+# the next import invalidates the cached responses, this only bounds how long
+# the ones of the previous generations stay in the cache
+API_CACHE_TIMEOUT = getattr(settings, "PARLTRACK_MEPS_API_CACHE_TIMEOUT", 24 * 60 * 60)
+
+
+def data_generation():
+    "(generation, date) of the last successful import, (0, None) before the first one"
+    return ImportCheckpoint.objects.filter(id=1).values_list("generation", "generated").first() or (0, None)
+
+
+def timestamp(moment):
+    if timezone.is_aware(moment):
+        return calendar.timegm(moment.utctimetuple())
+    return int(time.mktime(moment.timetuple()))
+
+
+class GenerationCachedResource(ModelResource):
+    """
+    GET responses carry the import generation in their ETag and its date
+    as Last-Modified, conditional requests are answered with a 304 and the
+    serialized responses are cached per generation, so the next import
+    invalidates them all.
+    """
+    def wrap_view(self, view):
+        view = super(GenerationCachedResource, self).wrap_view(view)
+
+        @csrf_exempt
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(request, *args, **kwargs)
+            return cached_response(request, view, *args, **kwargs)
+        return wrapper
+
+
+class SparseFieldsResource(GenerationCachedResource):
+    """
+    ?fields=a,b only serializes those fields (plus resource_uri) and only
+    loads their columns and relations. ?include=x,y inlines the relations
+    listed in includes, fetched in the same queries as the rows
+    (select_related) or in one query each (prefetch_related).
+    """
+    # include name -> lookups of the relation (and of the foreign keys of
+    # its rows to inline with them), the first part being shared
+    includes = {}
+
+    def requested(self, request, name, known):
+        if request is None or not request.GET.get(name):
+            return None
+        requested = [value.strip() for value in request.GET[name].split(",") if value.strip()]
+        unknown = [value for value in requested if value not in known]
+        if unknown:
+            raise BadRequest("Unknown %s: %s." % (name, ", ".join(unknown)))
+        return requested
+
+    def get_object_list(self, request):
+        objects = super(SparseFieldsResource, self).get_object_list(request)
+        if request is None or request.method != "GET":
+            return objects
+        fields = self.requested(request, "fields", self.fields)
+        includes = self.requested(request, "include", self.includes) or []
+        model = objects.model
+        related = []
+        for name in includes:
+            for lookup in self.includes[name]:
+                related.append(lookup)
+
+        if fields is not None:
+            attributes = set(self.fields[name].attribute for name in fields
+                             if isinstance(self.fields[name].attribute, basestring))
+            columns = set([model._meta.pk.name])
+            for attribute in attributes | set(lookup.split("__")[0] for lookup in related):
+                try:
+                    columns.add(model._meta.get_field(attribute).name)
+                except FieldDoesNotExist:
+                    pass  # reverse relation
+            # keep the joins and prefetches of the requested fields only
+            if isinstance(objects.query.select_related, dict):
+                selected = dict((key, value) for key, value in objects.query.select_related.items()
+                                if key in attributes)
+                objects.query.select_related = selected or False
+            prefetched = [lookup for lookup in objects._prefetch_related_lookups
+                          if lookup.split("__")[0] in attributes]
+            objects = objects.prefetch_related(None).prefetch_related(*prefetched).only(*columns)
+
+        selected = [lookup for lookup in related if isinstance(_field(model, lookup.split("__")[0]), ForeignKey)]
+        if selected:
+            # select_related() replaces the previous lookups on Django 1.6
+            if isinstance(objects.query.select_related, dict):
+                selected += _lookups(objects.query.select_related)
+            objects = objects.select_related(*selected)
+        return objects.prefetch_related(*[lookup for lookup in related if lookup not in selected])
+
+    def full_dehydrate(self, bundle, for_list=False):
+        fields = self.requested(bundle.request, "fields", self.fields)
+        if fields is None:
+            bundle = super(SparseFieldsResource, self).full_dehydrate(bundle, for_list)
+        else:
+            # tastypie's full_dehydrate, restricted to the requested fields
+            fields = set(fields) | set(["resource_uri"])
+            for field_name, field_object in self.fields.items():
+                if field_name not in fields:
+                    continue
+                if getattr(field_object, "dehydrated_type", None) == "related":
+                    field_object.api_name = self._meta.api_name
+                    field_object.resource_name = self._meta.resource_name
+                bundle.data[field_name] = field_object.dehydrate(bundle, for_list=for_list)
+                method = getattr(self, "dehydrate_%s" % field_name, None)
+                if method:
+                    bundle.data[field_name] = method(bundle)
+            bundle = self.dehydrate(bundle)
+
+        for name in self.requested(bundle.request, "include", self.includes) or []:
+            bundle.data[name] = inline(bundle.obj, self.includes[name])
+        return bundle
+
+
+def _field(model, name):
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+
+def _lookups(select_related):
+    "select_related lookups of a query.select_related dict"
+    lookups = []
+    for name, nested in select_related.items():
+        lookups.extend(["%s__%s" % (name, lookup) for lookup in _lookups(nested)] or [name])
+    return lookups
+
+
+def _columns(obj):
+    return dict((field.attname, getattr(obj, field.attname)) for field in obj._meta.concrete_fields)
+
+
+def inline(obj, lookups):
+    """
+    The columns of the object (or list of objects) obj.<relation>, the
+    relation being the first part of lookups, with the ones of the foreign
+    keys named by the second part of lookups
+    """
+    relation = lookups[0].split("__")[0]
+    nested = [lookup.split("__", 1)[1] for lookup in lookups if "__" in lookup]
+
+    def row(value):
+        data = _columns(value)
+        for name in nested:
+            target = getattr(value, name)
+            data[name] = _columns(target) if target is not None else None
+        return data
+
+    value = getattr(obj, relation)
+    if hasattr(value, "all"):
+        return [row(item) for item in value.all()]
+    return row(value) if value is not None else None
+
+
+def cached_response(request, view, *args, **kwargs):
+    generation, generated = data_generation()
+    # the format can be picked by the Accept header as well as ?format=
+    variant = hashlib.md5("%s %s" % (request.get_full_path(), request.META.get("HTTP_ACCEPT", ""))).hexdigest()
+    etag = '"%d-%s"' % (generation, variant[:16])
+    last_modified = timestamp(generated) if generated else None
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if_modified_since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    if if_none_match:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    else:
+        not_modified = last_modified is not None and if_modified_since is not None and last_modified <= if_modified_since
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        key = "parltrack_meps.api.%d.%s" % (generation, variant)
+        cached = cache.get(key)
+        if cached is not None:
+            response = HttpResponse(cached[0], content_type=cached[1])
+        else:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            # the streamed exports are too big to be kept in the cache
+            if not response.streaming:
+                cache.set(key, (response.content, response["Content-Type"]), API_CACHE_TIMEOUT)
+
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    patch_vary_headers(response, ("Accept",))
+    return response
+
+
+class MEPCountryResource(SparseFieldsResource):
     countrymep_set = fields.ToManyField("parltrack_meps.api.MEPCountryMEPResource", "countrymep_set")
 
     class Meta:
-        queryset = Country.objects.all()
+        queryset = Country.objects.prefetch_related("countrymep_set")
+        paginator_class = KeysetPaginator
 
 
-class MEPLocalPartyResource(ModelResource):
+class MEPLocalPartyResource(SparseFieldsResource):
     countrymep_set = fields.ToManyField("parltrack_meps.api.MEPCountryMEPResource", "countrymep_set")
     country = fields.ForeignKey(MEPCountryResource, "country")
 
     class Meta:
-        queryset = LocalParty.objects.all()
+        queryset = Party.objects.select_related("country").prefetch_related("countrymep_set")
+        paginator_class = KeysetPaginator
 
 
-class MEPGroupResource(ModelResource):
+class MEPGroupResource(SparseFieldsResource):
     groupmep_set = fields.ToManyField("parltrack_meps.api.MEPGroupMEPResource", "groupmep_set")
     class Meta:
-        queryset = Group.objects.all()
+        queryset = Group.objects.prefetch_related("groupmep_set")
+        paginator_class = KeysetPaginator
 
 
-class MEPDelegationResource(ModelResource):
+class MEPDelegationResource(SparseFieldsResource):
     delegationrole_set = fields.ToManyField("parltrack_meps.api.MEPDelegationRoleResource", "delegationrole_set")
 
     class Meta:
-        queryset = Delegation.objects.all()
+        queryset = Delegation.objects.prefetch_related("delegationrole_set")
+        paginator_class = KeysetPaginator
 
 
-class MEPCommitteeResource(ModelResource):
+class MEPCommitteeResource(SparseFieldsResource):
     committeerole_set = fields.ToManyField("parltrack_meps.api.MEPCommitteeRoleResource", "committeerole_set")
 
     class Meta:
-        queryset = Committee.objects.all()
+        queryset = Committee.objects.prefetch_related("committeerole_set")
+        paginator_class = KeysetPaginator
 
 
-class MEPBuildingResource(ModelResource):
+class MEPBuildingResource(SparseFieldsResource):
     class Meta:
         queryset = Building.objects.all()
+        paginator_class = KeysetPaginator
 
 
-class MEPOrganizationResource(ModelResource):
+class MEPOrganizationResource(SparseFieldsResource):
     organizationmep_set = fields.ToManyField("parltrack_meps.api.MEPOrganizationMEPResource", "organizationmep_set")
 
     class Meta:
-        queryset = Organization.objects.all()
+        queryset = Organization.objects.prefetch_related("organizationmep_set")
+        paginator_class = KeysetPaginator
 
 
-class MEPMEPResource(ModelResource):
-    bxl_building = fields.ForeignKey(MEPBuildingResource, "bxl_building")
-    stg_building = fields.ForeignKey(MEPBuildingResource, "stg_building")
+class MEPMEPResource(SparseFieldsResource):
+    bxl_building = fields.ForeignKey(MEPBuildingResource, "bxl_building", null=True)
+    stg_building = fields.ForeignKey(MEPBuildingResource, "stg_building", null=True)
     countrymep_set = fields.ToManyField("parltrack_meps.api.MEPCountryMEPResource", "countrymep_set")
     groupmep_set = fields.ToManyField("parltrack_meps.api.MEPGroupMEPResource", "groupmep_set")
     delegationrole_set = fields.ToManyField("parltrack_meps.api.MEPDelegationRoleResource", "delegationrole_set")
     committeerole_set = fields.ToManyField("parltrack_meps.api.MEPCommitteeRoleResource", "committeerole_set")
     organizationmep_set = fields.ToManyField("parltrack_meps.api.MEPOrganizationMEPResource", "organizationmep_set")
 
-    class Meta:
-        queryset = MEP.objects.all()
+    includes = {
+        "current_group": ("current_group",),
+        "current_country": ("current_country",),
+        "current_party": ("current_party",),
+        "bxl_building": ("bxl_building",),
+        "stg_building": ("stg_building",),
+        "groups": ("groupmep_set__group",),
+        "countries": ("countrymep_set__country", "countrymep_set__party"),
+        "committees": ("committeerole_set__committee",),
+        "delegations": ("delegationrole_set__delegation",),
+        "organizations": ("organizationmep_set__organization",),
+        "emails": ("email_set",),
+        "websites": ("website_set",),
+        "postal_addresses": ("postaladdress_set",),
+    }
 
-
-class MEPGroupMEPResource(ModelResource):
+    class Meta:
+        queryset = MEP.objects.select_related("bxl_building", "stg_building")\
+                             .prefetch_related("countrymep_set", "groupmep_set", "delegationrole_set",
+                                               "committeerole_set", "organizationmep_set")
+        paginator_class = KeysetPaginator
+        # only there to skip the unchanged records in update_meps
+        excludes = ["content_hash"]
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/export\.(?P<export_format>ndjson|csv)$" % self._meta.resource_name,
+                self.wrap_view("export"), name="api_mepmep_export"),
+        ]
+
+    def export(self, request, export_format, **kwargs):
+        """
+        The whole dataset in one streamed response, see export_meps.
+        ?active=1 only exports the active MEPs.
+        """
+        self.method_check(request, allowed=["get"])
+        queryset = MEP.objects.filter(active=True) if request.GET.get("active") else MEP.objects.all()
+        lines, content_type = EXPORT_FORMATS[export_format]
+        return StreamingHttpResponse(lines(export_records(queryset)), content_type=content_type)
+
+
+class MEPGroupMEPResource(SparseFieldsResource):
     group = fields.ForeignKey(MEPGroupResource, "group")
     mep = fields.ForeignKey(MEPMEPResource, "mep")
 
     class Meta:
-        queryset = GroupMEP.objects.all()
+        queryset = GroupMEP.objects.select_related("mep", "group")
+        paginator_class = PeriodKeysetPaginator
 
 
-class MEPDelegationRoleResource(ModelResource):
+class MEPDelegationRoleResource(SparseFieldsResource):
     mep = fields.ForeignKey(MEPMEPResource, "mep")
     delegation = fields.ForeignKey(MEPDelegationResource, "delegation")
 
     class Meta:
-        queryset = DelegationRole.objects.all()
+        queryset = DelegationRole.objects.select_related("mep", "delegation")
+        paginator_class = PeriodKeysetPaginator
 
 
-class MEPCommitteeRoleResource(ModelResource):
+class MEPCommitteeRoleResource(SparseFieldsResource):
     mep = fields.ForeignKey(MEPMEPResource, "mep")
     committee = fields.ForeignKey(MEPCommitteeResource, "committee")
 
     class Meta:
-        queryset = CommitteeRole.objects.all()
+        queryset = CommitteeRole.objects.select_related("mep", "committee")
+        paginator_class = PeriodKeysetPaginator
 
 
-class MEPPostalAddressResource(ModelResource):
+class MEPPostalAddressResource(SparseFieldsResource):
     mep = fields.ForeignKey(MEPMEPResource, "mep")
 
     class Meta:
-        queryset = PostalAddress.objects.all()
+        queryset = PostalAddress.objects.select_related("mep")
+        paginator_class = KeysetPaginator
 
 
-class MEPCountryMEPResource(ModelResource):
+class MEPCountryMEPResource(SparseFieldsResource):
     mep = fields.ForeignKey(MEPMEPResource, "mep")
     country = fields.ForeignKey(MEPCountryResource, "country")
     party = fields.ForeignKey(MEPLocalPartyResource, "party")
 
     class Meta:
-        queryset = CountryMEP.objects.all()
+        queryset = CountryMEP.objects.select_related("mep", "country", "party")
+        paginator_class = PeriodKeysetPaginator
 
 
-class MEPOrganizationMEPResource(ModelResource):
+class MEPOrganizationMEPResource(SparseFieldsResource):
     mep = fields.ForeignKey(MEPMEPResource, "mep")
     organization = fields.ForeignKey(MEPOrganizationResource, "organization")
 
     class Meta:
-        queryset = OrganizationMEP.objects.all()
+        queryset = OrganizationMEP.objects.select_related("mep", "organization")
+        paginator_class = PeriodKeysetPaginator
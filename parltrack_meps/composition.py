@@ -0,0 +1,108 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+"""
+Materialize the composition of the parliament over time in the
+Composition table, one row per change point.
+"""
+
+import json
+from datetime import timedelta
+from collections import defaultdict
+
+from parltrack_meps.models import CURRENT_MAGIC_VAL, Composition, CountryMEP, GroupMEP
+
+ONE_DAY = timedelta(days=1)
+
+
+def build_composition():
+    "Rebuild the Composition table from the group memberships and mandates"
+    groups = defaultdict(list)
+    for mep, group, begin, end in GroupMEP.objects.values_list("mep", "group__abbreviation", "begin", "end"):
+        if begin is not None:
+            groups[mep].append((begin, end, group))
+    countries = defaultdict(list)
+    for mep, country, begin, end in CountryMEP.objects.values_list("mep", "country__code", "begin", "end"):
+        if begin is not None:
+            countries[mep].append((begin, end, country))
+
+    # change of the seats counts at each date
+    deltas = defaultdict(lambda: defaultdict(int))
+    for mep in set(groups) | set(countries):
+        for day, delta in mep_deltas(groups[mep], countries[mep]):
+            for key, value in delta.items():
+                deltas[day][key] += value
+
+    rows = []
+    seats = defaultdict(int)
+    for day in sorted(deltas):
+        if not any(deltas[day].values()):
+            continue
+        for key, value in deltas[day].items():
+            seats[key] += value
+        if rows:
+            rows[-1].end = day - ONE_DAY
+        rows.append(composition(day, seats))
+
+    Composition.objects.all().delete()
+    Composition.objects.bulk_create(rows)
+    return len(rows)
+
+
+def mep_deltas(groups, countries):
+    """
+    Yield (date, {key: change}) for the seats a MEP holds, given their
+    (begin, end, group) and (begin, end, country) periods. The keys are
+    "seats", ("group", abbreviation), ("country", code) and ("group",
+    abbreviation, code); a MEP counts once per key even with overlapping
+    periods.
+    """
+    periods = groups + countries
+    days = set(begin for begin, end, _ in periods)
+    days.update(end + ONE_DAY for begin, end, _ in periods if end is not None and end != CURRENT_MAGIC_VAL)
+
+    previous = {}
+    for day in sorted(days):
+        in_groups = set(group for begin, end, group in groups if begin <= day and (end is None or day <= end))
+        in_countries = set(country for begin, end, country in countries if begin <= day and (end is None or day <= end))
+        state = dict.fromkeys([("group", group) for group in in_groups] +
+                              [("country", country) for country in in_countries] +
+                              [("group", group, country) for group in in_groups for country in in_countries], 1)
+        if in_countries:
+            state["seats"] = 1
+        delta = dict((key, state.get(key, 0) - previous.get(key, 0)) for key in set(state) | set(previous))
+        yield day, delta
+        previous = state
+
+
+def composition(day, seats):
+    "A Composition starting on day from the seats counts"
+    groups, countries, groups_by_country = {}, {}, defaultdict(dict)
+    for key, value in seats.items():
+        if not value or key == "seats":
+            continue
+        if key[0] == "country":
+            countries[key[1]] = value
+        elif len(key) == 2:
+            groups[key[1]] = value
+        else:
+            groups_by_country[key[2]][key[1]] = value
+    return Composition(begin=day, end=CURRENT_MAGIC_VAL, seats=seats["seats"],
+                       groups=json.dumps(groups, sort_keys=True),
+                       countries=json.dumps(countries, sort_keys=True),
+                       groups_by_country=json.dumps(groups_by_country, sort_keys=True))
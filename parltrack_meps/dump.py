@@ -0,0 +1,211 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+import os
+import json
+import zlib
+import codecs
+import hashlib
+import urllib2
+import urlparse
+from contextlib import closing
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+CHUNK_SIZE = 64 * 1024
+_WHITESPACE = u" \t\r\n"
+_SEPARATORS = _WHITESPACE + u","
+
+
+class DecompressingReader(object):
+    """
+    Read-only file-like object decompressing fileobj on the fly.
+
+    decompressor is any object with a decompress() method, like
+    zlib.decompressobj() or lzma.LZMADecompressor().
+    """
+    def __init__(self, fileobj, decompressor):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+        self.buffer = ""
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.fileobj.read(CHUNK_SIZE)
+            if data:
+                self.buffer += self.decompressor.decompress(data)
+            else:
+                self.eof = True
+                if hasattr(self.decompressor, "flush"):
+                    self.buffer += self.decompressor.flush()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+def open_dump(source):
+    """
+    Open the parltrack dump found at source (an url or a local path) for
+    reading, decompressing it in process if it ends with .xz or .gz.
+    """
+    if "://" in source:
+        fileobj = urllib2.urlopen(source)
+    else:
+        fileobj = open(source, "rb")
+
+    if source.endswith(".xz"):
+        if lzma is None:
+            fileobj.close()
+            raise Exception("lzma module missing, please install backports.lzma")
+        return DecompressingReader(fileobj, lzma.LZMADecompressor())
+    if source.endswith(".gz"):
+        # 16 + MAX_WBITS makes zlib expect a gzip header and trailer
+        return DecompressingReader(fileobj, zlib.decompressobj(16 + zlib.MAX_WBITS))
+    return fileobj
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fileobj:
+        for data in iter(lambda: fileobj.read(CHUNK_SIZE), ""):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def fetch_dump(url, cache_dir):
+    """
+    Make sure cache_dir holds the current version of the dump at url and
+    return its path and sha256.
+
+    The ETag and Last-Modified headers of the previous download are sent
+    back, so an unchanged dump costs a single 304 response.
+    The download is written to <path>.part and only renamed once complete,
+    a failed one leaves the previous dump in place.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, os.path.basename(urlparse.urlparse(url).path))
+    metadata_path = path + ".meta"
+
+    metadata = {}
+    if os.path.exists(path) and os.path.exists(metadata_path):
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        if metadata.get("url") != url:
+            metadata = {}
+
+    request = urllib2.Request(url)
+    if metadata.get("etag"):
+        request.add_header("If-None-Match", metadata["etag"])
+    if metadata.get("last_modified"):
+        request.add_header("If-Modified-Since", metadata["last_modified"])
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code != 304:
+            raise
+        return path, metadata["sha256"]
+
+    # the previous dump is only replaced once the new one is complete
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with closing(response), open(path + ".part", "wb") as part:
+            for data in iter(lambda: response.read(CHUNK_SIZE), ""):
+                sha256.update(data)
+                part.write(data)
+                size += len(data)
+        # httplib doesn't complain about a connection closed too early
+        length = response.info().getheader("Content-Length")
+        if length is not None and int(length) != size:
+            raise IOError("incomplete download of %s: %d bytes out of %s" % (url, size, length))
+    except:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        raise
+    os.rename(path + ".part", path)
+
+    metadata = {
+        "url": url,
+        "etag": response.info().getheader("ETag"),
+        "last_modified": response.info().getheader("Last-Modified"),
+        "sha256": sha256.hexdigest(),
+    }
+    with open(metadata_path, "w") as metadata_file:
+        json.dump(metadata, metadata_file)
+    return path, metadata["sha256"]
+
+
+def iter_json_array(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Yield the items of the JSON array stored in fileobj one at a time.
+
+    Only the item being decoded (plus one chunk) is ever held in memory, so
+    this works on dumps much bigger than the available RAM.
+    """
+    reader = codecs.getreader("utf-8")(fileobj)
+    decoder = json.JSONDecoder()
+    buffer = u""
+    position = 0
+    in_array = False
+
+    while True:
+        skip = _SEPARATORS if in_array else _WHITESPACE
+        while position < len(buffer) and buffer[position] in skip:
+            position += 1
+
+        if position == len(buffer):
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                raise ValueError("unexpected end of the JSON array")
+            buffer, position = chunk, 0
+            continue
+
+        if not in_array:
+            if buffer[position] != u"[":
+                raise ValueError("expected a JSON array, got %r" % buffer[position])
+            in_array = True
+            position += 1
+            continue
+
+        if buffer[position] == u"]":
+            return
+
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # the item is most likely cut by the end of the buffer
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+
+        yield item
@@ -0,0 +1,169 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+"""
+Export every MEP with their affiliations, addresses, emails and websites
+as NDJSON or CSV, one chunk of MEPs at a time so memory stays flat
+whatever the size of the database.
+"""
+
+import csv
+import json
+
+from parltrack_meps.models import (CURRENT_MAGIC_VAL, MEP, GroupMEP, CountryMEP,
+                                   CommitteeRole, DelegationRole, OrganizationMEP,
+                                   PostalAddress, Email, WebSite)
+
+# also the size of the mep__in lookups, like update_meps.chunks(): SQLite
+# accepts at most 999 parameters per query
+EXPORT_CHUNK_SIZE = 500
+
+MEP_COLUMNS = ("id", "ep_id", "active", "full_name", "first_name", "last_name",
+               "last_name_with_prefix", "gender", "birth_date", "birth_place")
+
+# name of the MEP fields in the export -> lookup
+CURRENT_COLUMNS = (
+    ("current_group", "current_group__abbreviation"),
+    ("current_country", "current_country__code"),
+    ("current_party", "current_party__name"),
+)
+
+OFFICE_COLUMNS = ("building", "floor", "office_number", "phone1", "phone2", "fax")
+
+# key of the export -> model, columns of each row
+PERIODS = (
+    ("groups", GroupMEP, (("abbreviation", "group__abbreviation"), ("name", "group__name"), ("role", "role"))),
+    ("countries", CountryMEP, (("code", "country__code"), ("name", "country__name"), ("party", "party__name"))),
+    ("committees", CommitteeRole, (("abbreviation", "committee__abbreviation"), ("name", "committee__name"), ("role", "role"))),
+    ("delegations", DelegationRole, (("name", "delegation__name"), ("role", "role"))),
+    ("organizations", OrganizationMEP, (("name", "organization__name"), ("role", "role"))),
+)
+
+# key of the export -> model, column
+VALUES = (
+    ("postal_addresses", PostalAddress, "addr"),
+    ("emails", Email, "email"),
+    ("websites", WebSite, "url"),
+)
+
+
+def _date(value):
+    if value is None or value == CURRENT_MAGIC_VAL:
+        return None
+    return value.isoformat()
+
+
+def _by_mep(model, pks, lookups):
+    rows = {}
+    for start in range(0, len(pks), EXPORT_CHUNK_SIZE):
+        chunk = pks[start:start + EXPORT_CHUNK_SIZE]
+        for row in model.objects.filter(mep__in=chunk).order_by("mep", "id").values_list("mep", *lookups):
+            rows.setdefault(row[0], []).append(row[1:])
+    return rows
+
+
+def export_records(queryset=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield a dict per MEP of queryset (all of them by default), in id order.
+
+    The MEPs are read by chunks of chunk_size ids, with one query per
+    related table and chunk, so a full export takes a few dozen queries.
+    Running periods have a None end.
+    """
+    if queryset is None:
+        queryset = MEP.objects.all()
+    lookups = MEP_COLUMNS + tuple(lookup for name, lookup in CURRENT_COLUMNS) +\
+        tuple("%s_%s" % (town, column) for town in ("bxl", "stg") for column in OFFICE_COLUMNS)
+    last = None
+    while True:
+        chunk = queryset.order_by("id")
+        if last is not None:
+            chunk = chunk.filter(id__gt=last)
+        meps = list(chunk.values_list(*lookups)[:chunk_size])
+        if not meps:
+            return
+        pks = [mep[0] for mep in meps]
+        last = pks[-1]
+
+        periods = [(name, _by_mep(model, pks, [lookup for key, lookup in columns] + ["begin", "end"]), columns)
+                   for name, model, columns in PERIODS]
+        values = [(name, _by_mep(model, pks, [column])) for name, model, column in VALUES]
+
+        for mep in meps:
+            record = dict(zip(MEP_COLUMNS, mep))
+            record["birth_date"] = _date(record["birth_date"])
+            position = len(MEP_COLUMNS)
+            for name, lookup in CURRENT_COLUMNS:
+                record[name] = mep[position]
+                position += 1
+            for town in ("bxl", "stg"):
+                record[town] = dict(zip(OFFICE_COLUMNS, mep[position:position + len(OFFICE_COLUMNS)]))
+                position += len(OFFICE_COLUMNS)
+
+            for name, rows, columns in periods:
+                record[name] = [dict(zip([key for key, lookup in columns], row[:-2]),
+                                     begin=_date(row[-2]), end=_date(row[-1]))
+                                for row in rows.get(record["id"], [])]
+            for name, rows in values:
+                record[name] = [row[0] for row in rows.get(record["id"], [])]
+            yield record
+
+
+def iter_ndjson(records):
+    "One JSON object per line"
+    for record in records:
+        yield json.dumps(record, sort_keys=True) + "\n"
+
+
+class _Line(object):
+    "File-like object handing back what csv.writer writes to it"
+    def write(self, value):
+        return value
+
+
+def _period(period, columns):
+    details = [period[key] for key, lookup in columns[1:] if key != "name" and period[key]]
+    return u"%s (%s) %s..%s" % (period[columns[0][0]], u", ".join(details),
+                                period["begin"] or u"", period["end"] or u"")
+
+
+def iter_csv(records):
+    """
+    A header then one line per MEP. Each period is written as
+    "<abbreviation or code or name> (<role or party>) <begin>..<end>",
+    the periods and the other lists being separated by "; ".
+    """
+    header = list(MEP_COLUMNS) + [name for name, lookup in CURRENT_COLUMNS] +\
+        ["%s_%s" % (town, column) for town in ("bxl", "stg") for column in OFFICE_COLUMNS] +\
+        [name for name, model, columns in PERIODS] + [name for name, model, column in VALUES]
+    writer = csv.writer(_Line())
+    yield writer.writerow(header)
+    for record in records:
+        row = [record[column] for column in MEP_COLUMNS] +\
+            [record[name] for name, lookup in CURRENT_COLUMNS] +\
+            [record[town][column] for town in ("bxl", "stg") for column in OFFICE_COLUMNS] +\
+            [u"; ".join(_period(period, columns) for period in record[name]) for name, model, columns in PERIODS] +\
+            [u"; ".join(record[name]) for name, model, column in VALUES]
+        yield writer.writerow([(u"" if value is None else unicode(value)).encode("utf-8") for value in row])
+
+
+# format -> (lines of the export, content type)
+EXPORT_FORMATS = {
+    "ndjson": (iter_ndjson, "application/x-ndjson"),
+    "csv": (iter_csv, "text/csv; charset=utf-8"),
+}
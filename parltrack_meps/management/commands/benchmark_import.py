@@ -0,0 +1,162 @@
+# encoding: utf-8
+
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from os.path import join
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from parltrack_meps.synthetic import generate_meps, churn, write_dump
+
+SCENARIOS = (
+    ("cold", "cold import"),
+    ("unchanged", "no-change reimport"),
+    ("churn", "churn reimport"),
+)
+
+
+class Command(BaseCommand):
+    help = ('Run update_meps on synthetic dumps in a throwaway SQLite database: a cold import, '
+            'a reimport of the same MEPs and a reimport where some of them changed. '
+            'Reports the wall time, SQL queries and peak memory of each run')
+    option_list = BaseCommand.option_list + (
+        make_option('--meps',
+                    type='int',
+                    default=750,
+                    help='Number of MEPs of the dumps (default: 750)'),
+        make_option('--seed',
+                    type='int',
+                    default=0,
+                    help='Seed of the synthetic dumps (default: 0)'),
+        make_option('--churn',
+                    type='float',
+                    default=0.05,
+                    help='Share of the MEPs that changed in the last reimport (default: 0.05)'),
+        make_option('--workers',
+                    type='int',
+                    default=1,
+                    help='Passed to update_meps'),
+        make_option('--batch-size',
+                    type='int',
+                    help='Passed to update_meps'),
+        make_option('--output',
+                    metavar='PATH',
+                    help='Write the results as json to PATH'),
+        make_option('--compare',
+                    metavar='PATH',
+                    help='Show the change from the results of a previous run written with --output'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("benchmark_import runs against SQLite, use settings with a sqlite3 database")
+
+        previous = None
+        if options["compare"]:
+            with open(options["compare"]) as previous_file:
+                previous = json.load(previous_file)
+
+        directory = tempfile.mkdtemp(prefix="benchmark_meps")
+        try:
+            dumps = self.write_dumps(directory, options)
+            # an in memory database, created with the initial data
+            database = connection.creation.create_test_db(verbosity=0)
+            try:
+                results = [self.run(name, dumps[name], join(directory, name + ".report.json"), options)
+                           for name, _ in SCENARIOS]
+            finally:
+                connection.creation.destroy_test_db(database, verbosity=0)
+        finally:
+            shutil.rmtree(directory)
+
+        report = {
+            "options": dict((key, options[key]) for key in ("meps", "seed", "churn", "workers", "batch_size")),
+            "results": results,
+        }
+        self.show(report, previous)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                json.dump(report, output, indent=4)
+
+    def write_dumps(self, directory, options):
+        meps = generate_meps(options["meps"], options["seed"])
+        dumps = {
+            "cold": join(directory, "cold.json"),
+            "unchanged": join(directory, "unchanged.json"),
+            "churn": join(directory, "churn.json"),
+        }
+        write_dump(meps, dumps["cold"])
+        # same MEPs written differently: the file changed so it isn't skipped
+        # as a whole, every MEP goes through the per MEP unchanged check
+        write_dump(meps, dumps["unchanged"], indent=1)
+        write_dump(churn(meps, options["churn"], options["seed"] + 1), dumps["churn"])
+        return dumps
+
+    def run(self, name, dump, report_path, options):
+        update_options = {"source": dump, "workers": options["workers"], "profile": report_path}
+        if options["batch_size"]:
+            update_options["batch_size"] = options["batch_size"]
+
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            call_command("update_meps", **update_options)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+        return {
+            "scenario": name,
+            "seconds": report["seconds"],
+            "queries": report["queries"],
+            # of the whole process, it never goes down from one run to the next
+            "peak_memory_mb": report["peak_memory_mb"],
+            "meps_per_second": report["meps"]["count"] / report["seconds"],
+        }
+
+    def show(self, report, previous):
+        previous_results = dict((result["scenario"], result) for result in previous["results"]) if previous else {}
+        print "%d MEPs, %.0f%% churn" % (report["options"]["meps"], report["options"]["churn"] * 100)
+        print "%-20s %10s %10s %10s %10s" % ("", "seconds", "queries", "peak MB", "MEPs/s")
+        for result in report["results"]:
+            line = "%-20s %10.2f %10d %10.1f %10.0f" % (dict(SCENARIOS)[result["scenario"]], result["seconds"],
+                                                       result["queries"], result["peak_memory_mb"],
+                                                       result["meps_per_second"])
+            if result["scenario"] in previous_results:
+                before = previous_results[result["scenario"]]
+                line += "   (%s time, %s queries)" % (_change(before["seconds"], result["seconds"]),
+                                                      _change(before["queries"], result["queries"]))
+            print line
+
+
+def _change(before, after):
+    if not before:
+        return "n/a"
+    return "%+.0f%%" % ((after - before) * 100. / before)
+
+# vim:set shiftwidth=4 tabstop=4 expandtab:
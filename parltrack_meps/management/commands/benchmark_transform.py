@@ -0,0 +1,62 @@
+# encoding: utf-8
+
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+import time
+from contextlib import closing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from parltrack_meps import transform
+from parltrack_meps.dump import open_dump, iter_json_array
+
+
+class Command(BaseCommand):
+    args = '<dump>'
+    help = 'Measure how many parltrack records per second update_meps transforms, without touching the database'
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat',
+                    type='int',
+                    default=5,
+                    help='Number of times the records are transformed, the best run is kept (default: 5)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("usage: benchmark_transform <dump> (.xz, .gz or plain json)")
+
+        with closing(open_dump(args[0])) as dump:
+            records = list(iter_json_array(dump))
+        if not records:
+            raise CommandError("%s holds no record" % args[0])
+
+        best = None
+        for run in range(options["repeat"]):
+            # every import starts with an empty dates cache
+            transform._dates.clear()
+            start = time.time()
+            for record in records:
+                transform.transform(record)
+            seconds = time.time() - start
+            print "run %d: %d records in %.3fs, %.0f records/s" % (run + 1, len(records), seconds, len(records) / seconds)
+            best = seconds if best is None else min(best, seconds)
+        print "best: %.0f records/s" % (len(records) / best)
+
+# vim:set shiftwidth=4 tabstop=4 expandtab:
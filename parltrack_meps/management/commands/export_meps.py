@@ -0,0 +1,58 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from parltrack_meps.models import MEP
+from parltrack_meps.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_records
+
+
+class Command(BaseCommand):
+    args = '[<path>]'
+    help = 'Export every MEP with their affiliations, addresses, emails and websites as NDJSON or CSV (to stdout by default)'
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    choices=sorted(EXPORT_FORMATS),
+                    default='ndjson',
+                    help='ndjson (default) or csv'),
+        make_option('--active',
+                    action='store_true',
+                    default=False,
+                    help='Only export the active MEPs'),
+        make_option('--chunk-size',
+                    type='int',
+                    default=EXPORT_CHUNK_SIZE,
+                    help='Number of MEPs read at a time (default: %d)' % EXPORT_CHUNK_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("usage: export_meps [<path>]")
+
+        queryset = MEP.objects.filter(active=True) if options["active"] else MEP.objects.all()
+        lines = EXPORT_FORMATS[options["format"]][0](export_records(queryset, options["chunk_size"]))
+        output = open(args[0], "wb") if args else sys.stdout
+        try:
+            for line in lines:
+                output.write(line)
+        finally:
+            if args:
+                output.close()
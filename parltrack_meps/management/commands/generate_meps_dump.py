@@ -0,0 +1,87 @@
+# encoding: utf-8
+
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from parltrack_meps.synthetic import generate_meps, churn, write_dump
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = 'Write a synthetic parltrack dump of MEPs (.xz, .gz or plain json) to measure update_meps offline'
+    option_list = BaseCommand.option_list + (
+        make_option('--meps',
+                    type='int',
+                    default=750,
+                    help='Number of MEPs (default: 750)'),
+        make_option('--seed',
+                    type='int',
+                    default=0,
+                    help='The same seed and options always give the same dump (default: 0)'),
+        make_option('--churn',
+                    type='float',
+                    default=0,
+                    help='Share of the MEPs (0 to 1) that changed since the dump generated with the same seed and no --churn'),
+        make_option('--committees',
+                    type='float',
+                    default=3,
+                    help='Average number of committee roles of each MEP (default: 3)'),
+        make_option('--delegations',
+                    type='float',
+                    default=2,
+                    help='Average number of delegation roles of each MEP (default: 2)'),
+        make_option('--groups',
+                    type='int',
+                    default=1,
+                    help='Number of groups of each MEP (default: 1)'),
+        make_option('--constituencies',
+                    type='float',
+                    default=1,
+                    help='Average number of constituencies of each MEP (default: 1)'),
+        make_option('--assistants',
+                    type='float',
+                    default=4,
+                    help='Average number of assistants of each MEP (default: 4)'),
+        make_option('--no-addresses',
+                    action='store_false',
+                    dest='addresses',
+                    default=True,
+                    help='Leave the Brussels, Strasbourg and postal addresses out'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("usage: generate_meps_dump <path>")
+
+        meps = generate_meps(options["meps"], options["seed"],
+                             committees=options["committees"],
+                             delegations=options["delegations"],
+                             groups=options["groups"],
+                             constituencies=options["constituencies"],
+                             assistants=options["assistants"],
+                             addresses=options["addresses"])
+        if options["churn"]:
+            meps = churn(meps, options["churn"], options["seed"] + 1)
+        write_dump(meps, args[0])
+        print "wrote %d MEPs to %s" % (len(meps), args[0])
+
+# vim:set shiftwidth=4 tabstop=4 expandtab:
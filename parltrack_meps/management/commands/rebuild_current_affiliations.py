@@ -0,0 +1,45 @@
+# encoding: utf-8
+
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from parltrack_meps.models import MEP
+from parltrack_meps.affiliations import CURRENT_AFFILIATIONS, current_affiliations, save_current_affiliations
+
+
+class Command(BaseCommand):
+    help = 'Recompute the current group, country and party of every MEP from their GroupMEP and CountryMEP'
+
+    def handle(self, *args, **options):
+        meps = dict((mep.pk, mep) for mep in MEP.objects.only("current_group", "current_country", "current_party"))
+        current = dict((pk, {}) for pk in meps)
+        for model, fields in CURRENT_AFFILIATIONS:
+            periods = {}
+            for period in model.objects.only("mep", "begin", "end", *fields):
+                periods.setdefault(period.mep_id, []).append(period)
+            for pk in meps:
+                current[pk].update(current_affiliations(periods.get(pk, []), fields))
+
+        with transaction.commit_on_success():
+            changed = save_current_affiliations(meps, current)
+        print "%d MEPs out of %d updated" % (changed, len(meps))
+
+# vim:set shiftwidth=4 tabstop=4 expandtab:
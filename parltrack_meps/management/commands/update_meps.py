@@ -18,15 +18,20 @@
 #
 # Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
 
-import os
+import sys
 import json
+import cProfile
+import tempfile
 from os.path import join
-from datetime import datetime
-import urllib
+from itertools import islice
+from contextlib import closing
+from optparse import make_option
 
-from django.core.management.base import BaseCommand
-from django.db.models import Count
-from django.db import transaction
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import ForeignKey
+from django.db import transaction, connection
+from django.utils import timezone
 
 from parltrack_meps.models import (Party, MEP, Delegation,
                                           DelegationRole, PostalAddress,
@@ -34,358 +39,598 @@ from parltrack_meps.models import (Party, MEP, Delegation,
                                           OrganizationMEP, Committee,
                                           CommitteeRole, Group, GroupMEP,
                                           Building, Assistant, AssistantMEP,
-                                          PartyMEP, Email, WebSite, CV, NameVariation)
+                                          PartyMEP, Email, WebSite, CV, NameVariation,
+                                          ImportCheckpoint, Composition, Office)
+from parltrack_meps.dump import open_dump, fetch_dump, file_sha256, iter_json_array
+from parltrack_meps.transform import iter_transform
+from parltrack_meps.composition import build_composition
+from parltrack_meps.affiliations import CURRENT_AFFILIATIONS, current_affiliations
+from parltrack_meps.shadow import ShadowTables, ShadowError
+from parltrack_meps.profiling import Profiler, NullProfiler, profiled, peak_memory_usage
+
+PARLTRACK_DUMP_URL = getattr(settings, "PARLTRACK_MEPS_DUMP_URL", "http://parltrack.euwiki.org/dumps/ep_meps_current.json.xz")
+CACHE_DIR = getattr(settings, "PARLTRACK_MEPS_CACHE_DIR", join(tempfile.gettempdir(), "parltrack_meps"))
+BATCH_SIZE = 100
+COMMIT_EVERY = 500
+
+
+class Dimension(object):
+    """
+    Identity map of a dimension table (Committee, Group, Party...) indexed
+    by its natural key.
+
+    The whole table is loaded once, rows that don't exist yet are built
+    unsaved by get() and created in bulk by save_missing(). The natural keys
+    handed out by get() are remembered so prune() only has to look at the
+    other rows.
+    """
+    def __init__(self, model, *key):
+        self.model = model
+        self.key = key
+        self.rows = {}
+        self.missing = {}
+        self.referenced = set()
+        self.pks = set()
+        # natural keys aren't unique everywhere, keep the oldest row like
+        # the get_or_create() of the previous importer did
+        for row in model.objects.order_by("-pk"):
+            self.rows[self.natural_key(row)] = row
+            self.pks.add(row.pk)
+
+    def natural_key(self, row):
+        if len(self.key) == 1:
+            return getattr(row, self.key[0])
+        return tuple(getattr(row, field) for field in self.key)
+
+    def __getitem__(self, natural_key):
+        try:
+            return self.rows[natural_key]
+        except KeyError:
+            raise self.model.DoesNotExist("%s %r" % (self.model.__name__, natural_key))
+
+    def get(self, natural_key, **fields):
+        self.referenced.add(natural_key)
+        if natural_key in self.rows:
+            return self.rows[natural_key]
+        if natural_key not in self.missing:
+            self.missing[natural_key] = self.model(**fields)
+        return self.missing[natural_key]
+
+    @profiled
+    def save_missing(self):
+        if not self.missing:
+            return
+        self.model.objects.bulk_create(self.missing.values())
+        if self.key != (self.model._meta.pk.attname,):
+            # bulk_create() doesn't set the primary keys, fetch them back
+            values = set(getattr(row, self.key[0]) for row in self.missing.values())
+            for chunk in chunks(values):
+                for row in self.model.objects.filter(**{"%s__in" % self.key[0]: chunk}):
+                    if self.natural_key(row) in self.missing:
+                        self.missing[self.natural_key(row)].pk = row.pk
+        for row in self.missing.values():
+            row._state.adding = False
+        self.rows.update(self.missing)
+        self.pks.update(row.pk for row in self.missing.values())
+        self.missing = {}
+
+    def unreferenced(self):
+        "Primary keys of the rows get() didn't hand out during this import"
+        return self.pks - set(self.rows[natural_key].pk for natural_key in self.referenced)
+
+
+class DimensionCache(object):
+    "Dimension tables referenced by the MEPs, loaded once per import"
+    def __init__(self):
+        self.countries = Dimension(Country, "name")
+        self.committees = Dimension(Committee, "abbreviation")
+        self.delegations = Dimension(Delegation, "name")
+        self.organizations = Dimension(Organization, "name")
+        self.groups = Dimension(Group, "abbreviation")
+        self.parties = Dimension(Party, "name", "country_id")
+        self.buildings = Dimension(Building, "id")
+        self.assistants = Dimension(Assistant, "full_name")
+
+    def imported(self):
+        "The dimensions filled by the import, countries are reference data"
+        return (self.committees, self.delegations, self.organizations,
+                self.groups, self.parties, self.buildings, self.assistants)
+
+    def save_missing(self):
+        for dimension in self.imported():
+            dimension.save_missing()
+
+
+class BatchWriter(object):
+    """
+    Buffer the MEPs and their relationship rows (CommitteeRole, GroupMEP...)
+    and write them to the database a whole batch at a time, with a few
+    queries per table instead of a couple of queries per row.
+
+    Rows and MEPs may point to dimension rows that aren't created yet, their
+    foreign keys are only resolved when the batch is flushed, once all the
+    missing dimension rows were created together.
+    """
+    # rows replacing the ones already linked to the MEP
+    models = (CommitteeRole, DelegationRole, CountryMEP, PartyMEP, GroupMEP,
+              OrganizationMEP, PostalAddress)
+    # rows added to the ones already linked to the MEP
+    add_only_models = (AssistantMEP, Email, WebSite, CV, NameVariation)
+
+    def __init__(self, cache, batch_size=BATCH_SIZE):
+        self.cache = cache
+        self.batch_size = batch_size
+        self.rows = dict((model, {}) for model in self.models + self.add_only_models)
+        self.meps = {}
+
+    def replace(self, mep, model, rows):
+        "Replace all the rows of model linked to mep by rows"
+        self.rows[model][mep.pk] = rows
+
+    def add(self, mep, model, rows):
+        "Add the rows to the ones of model linked to mep, unless they exist already"
+        self.rows[model].setdefault(mep.pk, []).extend(rows)
+
+    def save(self, mep):
+        "Save mep with the batch, its primary key has to be set already"
+        self.meps[mep.pk] = mep
+
+    def flush_if_full(self):
+        if len(self.meps) >= self.batch_size:
+            self.flush()
+
+    @profiled
+    def flush(self):
+        self.cache.save_missing()
+        for mep in self.meps.values():
+            resolve_foreign_keys(mep)
+        for model, fields in CURRENT_AFFILIATIONS:
+            for pk, rows in self.rows[model].items():
+                for row in rows:
+                    resolve_foreign_keys(row)
+                for column, value in current_affiliations(rows, fields).items():
+                    setattr(self.meps[pk], "%s_id" % column, value)
+        for mep in self.meps.values():
+            mep.save()
+        # left by older imports, replaced by the websites of the batch
+        for chunk in chunks(self.rows[WebSite].keys()):
+            WebSite.objects.filter(mep__in=chunk, url="").delete()
+        for model in self.models + self.add_only_models:
+            if self.rows[model]:
+                self.reconcile(model, self.rows[model], model in self.add_only_models)
+                self.rows[model] = {}
+        self.meps = {}
+
+    def reconcile(self, model, rows_by_mep, add_only=False):
+        """
+        Make the rows of model linked to the MEPs of rows_by_mep match the
+        new ones, comparing them as sets of (mep, target, role, begin, end)
+        tuples: rows that didn't change keep their primary key, only the
+        vanished ones are deleted and only the new ones inserted.
+
+        With add_only nothing is deleted, only the rows that don't exist
+        yet are inserted, once each.
+        """
+        fields = [field for field in model._meta.local_fields if not field.primary_key]
+        key = lambda values: tuple(field.to_python(value) for field, value in zip(fields, values))
+
+        existing = {}
+        for chunk in chunks(rows_by_mep.keys()):
+            for values in model.objects.filter(mep__in=chunk).values_list("pk", *[field.attname for field in fields]):
+                existing.setdefault(key(values[1:]), []).append(values[0])
+
+        new_rows = []
+        for rows in rows_by_mep.values():
+            for row in rows:
+                resolve_foreign_keys(row)
+                values = key([getattr(row, field.attname) for field in fields])
+                if add_only:
+                    if values not in existing:
+                        existing[values] = []
+                        new_rows.append(row)
+                elif existing.get(values):
+                    existing[values].pop()
+                else:
+                    new_rows.append(row)
+
+        if not add_only:
+            for chunk in chunks([pk for pks in existing.values() for pk in pks]):
+                model.objects.filter(pk__in=chunk).delete()
+        model.objects.bulk_create(new_rows, batch_size=self.batch_size)
+
 
-# XXX
-JSON_DUMP_ARCHIVE_LOCALIZATION = join("/tmp", "ep_meps_current.json.xz")
-JSON_DUMP_LOCALIZATION = join("/tmp", "ep_meps_current.json")
-_parse_date = lambda date: datetime.strptime(date, "%Y-%m-%dT00:%H:00")
+def resolve_foreign_keys(row):
+    "Copy the primary keys of the rows row points to, created since they were set"
+    for field in row._meta.local_fields:
+        if isinstance(field, ForeignKey):
+            target = getattr(row, field.get_cache_name(), None)
+            if target is not None:
+                setattr(row, field.attname, target.pk)
 
 
-def get_or_create(klass, _id=None, **kwargs):
-    if _id is None:
-        object = klass.objects.filter(**kwargs)
-    else:
-        object = klass.objects.filter(**{_id: kwargs[_id]})
-    if object:
-        return object[0]
-    else:
-        # print "     add new", klass.__name__, kwargs
-        return klass.objects.create(**kwargs)
+def chunks(sequence, size=500):
+    "Split sequence in lists small enough to be used in a __in lookup"
+    sequence = list(sequence)
+    for i in range(0, len(sequence), size):
+        yield sequence[i:i + size]
 
 
 class Command(BaseCommand):
     help = 'Update the eurodeputies data by pulling it from parltrack'
+    option_list = BaseCommand.option_list + (
+        make_option('--source',
+                    default=PARLTRACK_DUMP_URL,
+                    help='Url or path of the dump to import, .xz, .gz or plain json (default: %s)' % PARLTRACK_DUMP_URL),
+        make_option('--cache-dir',
+                    default=CACHE_DIR,
+                    help='Where the downloaded dump is kept between two runs (default: %s)' % CACHE_DIR),
+        make_option('--batch-size',
+                    type='int',
+                    default=BATCH_SIZE,
+                    help='Number of MEPs whose relationship rows are written together (default: %d)' % BATCH_SIZE),
+        make_option('--force',
+                    action='store_true',
+                    default=False,
+                    help='Reimport every MEP, even the ones that didn\'t change since the last import, or the whole dump if it didn\'t change at all'),
+        make_option('--workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes transforming the parltrack records while this one writes them (default: 1, no extra process)'),
+        make_option('--commit-every',
+                    type='int',
+                    default=COMMIT_EVERY,
+                    help='Commit the import every N MEPs, 0 to import everything in one transaction (default: %d)' % COMMIT_EVERY),
+        make_option('--resume',
+                    action='store_true',
+                    default=False,
+                    help='Continue an interrupted import of the same dump from its last commit'),
+        make_option('--shadow',
+                    action='store_true',
+                    default=False,
+                    help='Import into copies of the tables and swap them with the live ones only once the import is done and validated'),
+        make_option('--prune-dry-run',
+                    action='store_true',
+                    default=False,
+                    help='Only report the committees, groups, parties... no MEP refers to anymore instead of deleting them'),
+        make_option('--profile',
+                    metavar='PATH',
+                    help='Write a json report of the time, queries and memory spent by each phase of the import to PATH ("-" for stdout, the progress then goes to stderr)'),
+        make_option('--cprofile',
+                    metavar='PATH',
+                    help='Dump cProfile statistics of the import to PATH'),
+    )
 
     def handle(self, *args, **options):
-        if os.system("which unxz > /dev/null") != 0:
-            raise Exception("unxz binary missing, please install xz")
-        print "clean old downloaded files"
-        if os.path.exists(JSON_DUMP_ARCHIVE_LOCALIZATION):
-            os.remove(JSON_DUMP_ARCHIVE_LOCALIZATION)
-        if os.path.exists(JSON_DUMP_LOCALIZATION):
-            os.remove(JSON_DUMP_LOCALIZATION)
-        print "download lastest data dump of meps from parltrack"
-        urllib.urlretrieve('http://parltrack.euwiki.org/dumps/ep_meps_current.json.xz', JSON_DUMP_ARCHIVE_LOCALIZATION)
-        print "unxz dump"
-        os.system("unxz %s" % JSON_DUMP_ARCHIVE_LOCALIZATION)
-        print "load json"
-        meps = json.load(open(JSON_DUMP_LOCALIZATION, "r"))
-        print "Set all current active mep to unactive before importing"
-        with transaction.commit_on_success():
-            MEP.objects.filter(active=True).update(active=False)
-            a = 0
-            for mep_json in meps:
-                a += 1
-                print a, "-", mep_json["Name"]["full"].encode("Utf-8")
-                in_db_mep = MEP.objects.filter(ep_id=int(mep_json["UserID"]))
-                if in_db_mep:
-                    mep = in_db_mep[0]
-                    mep.active = mep_json['active']
-                    manage_mep(mep, mep_json)
-                else:
-                    mep = create_mep(mep_json)
-            clean()
-        print
-
-
-def add_committees(mep, committees):
-    CommitteeRole.objects.filter(mep=mep).delete()
-    for committee in committees:
-        if committee.get("committee_id"):
-            try:
-                    in_db_committe = Committee.objects.get(abbreviation=committee["committee_id"])
-            except Committee.DoesNotExist:
-                # print "     create new commitee:", committee["committee_id"], committee["Organization"]
-                in_db_committe = Committee.objects.create(name=committee["Organization"],
-                                                          abbreviation=committee["committee_id"])
-            # print "     link mep to commmitte:", committee["Organization"]
-            params = {}
-            if committee.get("start"):
-                params['begin'] = _parse_date(committee.get("start"))
-            if committee.get("end"):
-                params['end'] = _parse_date(committee.get("end"))
-            CommitteeRole.objects.create(mep=mep, committee=in_db_committe,
-                                         role=committee["role"],
-                                         begin=_parse_date(committee.get("start")),
-                                         end=_parse_date(committee.get("end")))
-        #else:
-            # FIXME create or how abbreviations ? Or are they really important ? or create a new class ?
-            # print "WARNING: committe without abbreviation:", committee["Organization"]
-
-
-def add_delegations(mep, delegations):
-    DelegationRole.objects.filter(mep=mep).delete()
-    for delegation in delegations:
-        db_delegation = get_or_create(Delegation, name=delegation["Organization"])
-        # print "     create DelegationRole to link mep to delegation"
-        params = {}
-        if delegation.get("start"):
-            params['begin'] = _parse_date(delegation["start"])
-        if delegation.get("end"):
-            params['end'] = _parse_date(delegation["end"])
-        DelegationRole.objects.create(mep=mep, delegation=db_delegation,
-                                      role=delegation["role"],
-                                      begin=_parse_date(delegation["start"]),
-                                      end=_parse_date(delegation["end"]))
-
-
-def add_addrs(mep, addrs):
-    if addrs.get("Brussels"):
-        # print "     add Brussels infos"
-        bxl = addrs["Brussels"]
-        if bxl["Address"].get("building_code"):
-            mep.bxl_building = get_or_create(Building, _id="id",
-                                         id=bxl["Address"]["building_code"],
-                                         name=bxl["Address"]["Building"],
-                                         street=bxl["Address"]["Street"],
-                                         postcode=bxl["Address"]["Zip"])
-        mep.bxl_floor = bxl["Address"]["Office"][:2]
-        mep.bxl_office_number = bxl["Address"]["Office"][2:]
-        mep.bxl_fax = bxl.get("Fax")
-        mep.bxl_phone1 = bxl["Phone"]
-        mep.bxl_phone2 = bxl["Phone"][:-4] + "7" + bxl["Phone"][-3:]
-    # print "     add Strasbourg infos"
-    if addrs.get("Strasbourg"):
-        stg = addrs["Strasbourg"]
-        if stg["Address"].get("building_code"):
-            mep.stg_building = get_or_create(Building, _id="id",
-                                         id=stg["Address"]["building_code"],
-                                         name=stg["Address"]["Building"],
-                                         street=stg["Address"]["Street"],
-                                         postcode=stg["Address"].get("Zip", stg["Address"]["Zip1"]))
-        mep.stg_floor = stg["Address"]["Office"][:3]
-        mep.stg_office_number = stg["Address"]["Office"][3:]
-        mep.stg_fax = stg.get("Fax")
-        mep.stg_phone1 = stg.get("Phone")
-        if stg.get("Phone"):
-            mep.stg_phone2 = stg["Phone"][:-4] + "7" + stg["Phone"][-3:]
-        # print "     adding mep's postal addresses:"
-    mep.save()
-    PostalAddress.objects.filter(mep=mep).delete()
-    for addr in addrs.get("Postal", []):
-        # print "       *", addr.encode("Utf-8")
-        PostalAddress.objects.create(addr=addr, mep=mep)
-
-
-def add_countries(mep, countries):
-    PartyMEP.objects.filter(mep=mep).delete()
-    CountryMEP.objects.filter(mep=mep).delete()
-    # print "     add countries"
-    for country in countries:
-        if not country:
-            continue
-        # print country
-        # print "     link mep to country", '"%s"' % country["country"], "for a madate"
-        _country = Country.objects.get(name=country["country"])
-        if "party" in country:
-            party = get_or_create(Party, name=country["party"], country=_country)
-            if not PartyMEP.objects.filter(mep=mep, party=party):
-                #current = True if _parse_date(country["end"]).year > date.today().year else False
-                current = 'end' not in country
-                PartyMEP.objects.create(mep=mep, party=party, current=current)
+        if options["profile"]:
+            self.profiler = Profiler.current = Profiler(connection)
         else:
-            party = get_or_create(Party, name="unknown", country=_country)
-        params = {}
-        if country.get("start"):
-            params['begin'] = _parse_date(country["start"])
-        if country.get("end"):
-            params['end'] = _parse_date(country["end"])
-        CountryMEP.objects.create(mep=mep, country=_country, party=party,
-                                  begin=_parse_date(country["start"]),
-                                  end=_parse_date(country["end"]))
-
-
-def add_organizations(mep, organizations):
-    OrganizationMEP.objects.filter(mep=mep).delete()
-    for organization in organizations:
-        in_db_organization = get_or_create(Organization, name=organization["Organization"])
-        # print "     link mep to organization:", in_db_organization.name
-        params = {}
-        if organization.get("start"):
-            params['begin'] = _parse_date(organization["start"])
-        if organization.get("end"):
-            params['end'] = _parse_date(organization["end"])
-        OrganizationMEP.objects.create(mep=mep,
-                                       organization=in_db_organization,
-                                       role=organization["role"],
-                                       begin=_parse_date(organization["start"]),
-                                       end=_parse_date(organization["end"]))
-
-
-def change_mep_details(mep, mep_json):
-    if mep_json.get("Birth"):
-        # print "     update mep birth date"
-        mep.birth_date = _parse_date(mep_json["Birth"]["date"])
-        # print "     update mep birth place"
-        if "place" in mep_json["Birth"]:
-            mep.birth_place = mep_json["Birth"]["place"]
-    # print "     update mep first name"
-    mep.first_name = mep_json["Name"]["sur"]
-    # print "     update mep last name"
-    mep.last_name = mep_json["Name"]["family"]
-    # print "     update mep full name"
-    mep.full_name = "%s %s" % (mep_json["Name"]["sur"], mep_json["Name"]["family"])
-
-    fix_last_name_with_prefix = {
-        "Esther de LANGE": "de LANGE",
-        "Patricia van der KAMMEN": "van der KAMMEN",
-        "Judith A. MERKIES": "MERKIES",
-        "Heinz K. BECKER": "BECKER",
-        "Cornelis de JONG": "de JONG",
-        "Peter van DALEN": "van DALEN",
-        "Sophia in 't VELD": "in 't VELD",
-        "Marielle de SARNEZ": "de SARNEZ",
-        "Anne E. JENSEN": "JENSEN",
-        "Wim van de CAMP": "van de CAMP",
-        "Lambert van NISTELROOIJ": "van NISTELROOIJ",
-        "Johannes Cornelis van BAALEN": "van BAALEN",
-        "Ioannis A. TSOUKALAS": "TSOUKALAS",
-        "Pilar del CASTILLO VERA": "del CASTILLO VERA",
-        "Luis de GRANDES PASCUAL": "de GRANDES PASCUAL",
-        "Philippe de VILLIERS": "de VILLIERS",
-        "Daniël van der STOEP": "van der STOEP",
-        "William (The Earl of) DARTMOUTH": "(The Earl of) Dartmouth",
-        "Bairbre de BRÚN": u'de Br\xfan',
-        "Karl von WOGAU": u'von WOGAU',
-        "Ieke van den BURG": u'van den BURG',
-        "Manuel António dos SANTOS": u'dos SANTOS',
-        "Paul van BUITENEN": u'van BUITENEN',
-        "Elly de GROEN-KOUWENHOVEN": u'de GROEN-KOUWENHOVEN',
-        "Margrietus van den BERG": u'van den BERG',
-        u'Dani\xebl van der STOEP': u'van der STOEP',
-        "Alexander Graf LAMBSDORFF": u'Graf LAMBSDORFF',
-        u'Bairbre de BR\xdaN': u'de BR\xdaN',
-        'Luigi de MAGISTRIS': 'de MAGISTRIS',
-    }
-
-    if fix_last_name_with_prefix.get(mep.full_name):
-        mep.last_name_with_prefix = fix_last_name_with_prefix[mep.full_name]
-    elif mep.last_name == "J.A.J. STASSEN":
-        mep.last_name_with_prefix = "STASSEN"
-    else:
-        mep.last_name_with_prefix = mep.last_name
-
-    mep.swaped_name = "%s %s" % (mep.last_name, mep.first_name)
-
-    # print "     update mep gender"
-    if mep_json.get("Gender", u'n/a') == u'n/a':
-        mep.gender = None
-    else:
-        mep.gender = mep_json["Gender"]
-
-
-def add_mep_email(mep, emails):
-    if isinstance(emails, list):
-        for email in emails:
-            get_or_create(Email, mep=mep, email=email)
-    else:
-        get_or_create(Email, mep=mep, email=emails)
-
-
-def add_mep_website(mep, urls):
-    for url in urls:
-        get_or_create(WebSite, mep=mep, url=url)
-
-
-def add_mep_cv(mep, cv):
-    for c in cv:
-        if c:
-            get_or_create(CV, title=c, mep=mep)
-
-
-def add_groups(mep, groups):
-    # I don't create group if they don't exist for the moment
-    convert = {"S&D": "SD", "NA": "NI", "ID": "IND/DEM", "PPE": "EPP", "Verts/ALE": "Greens/EFA"}
-    GroupMEP.objects.filter(mep=mep).delete()
-    for group in groups:
-        if not group.get("groupid"):
-            continue
-        # print "     link mep to group", group["groupid"], group["Organization"]
-        if type(group["groupid"]) is list:
-            # I really don't like that hack
-            group["groupid"] = group["groupid"][0]
-        group["groupid"] = convert.get(group["groupid"], group["groupid"])
-        in_db_group = Group.objects.filter(abbreviation=group["groupid"])
-        if in_db_group:
-            in_db_group = in_db_group[0]
+            self.profiler = NullProfiler()
+        if options["cprofile"]:
+            cprofile = cProfile.Profile()
+            cprofile.enable()
+        stdout = sys.stdout
+        if options["profile"] == "-":
+            # keep stdout for the report
+            sys.stdout = sys.stderr
+
+        try:
+            self.import_dump(options)
+        finally:
+            sys.stdout = stdout
+            Profiler.current = None
+            if options["cprofile"]:
+                cprofile.disable()
+                cprofile.dump_stats(options["cprofile"])
+
+        if options["profile"] == "-":
+            json.dump(self.profiler.report(), sys.stdout, indent=4)
+        elif options["profile"]:
+            with open(options["profile"], "w") as output:
+                json.dump(self.profiler.report(), output, indent=4)
+
+    def import_dump(self, options):
+        source = options["source"]
+        with self.profiler.phase("download"):
+            if "://" in source:
+                print "fetch lastest data dump of meps from", source
+                source, identity = fetch_dump(source, options["cache_dir"])
+            else:
+                identity = file_sha256(source)
+
+        checkpoint = ImportCheckpoint.objects.get_or_create(id=1)[0]
+        if checkpoint.dump == identity and checkpoint.done and not options["force"]:
+            print "the dump didn't change since the last import, nothing to do"
+            return
+
+        if options["shadow"]:
+            if options["resume"]:
+                raise CommandError("--resume can't be used with --shadow, shadow imports always start over")
+            self.shadow_import(source, identity, options)
         else:
-            in_db_group = Group.objects.create(abbreviation=group["groupid"], name=group["Organization"])
-        params = {}
-        if group.get("start"):
-            params['begin'] = _parse_date(group["start"])
-        if group.get("end"):
-            params['end'] = _parse_date(group["end"])
-        GroupMEP.objects.create(mep=mep, group=in_db_group, role=group["role"],
-                                begin=_parse_date(group["start"]),
-                                end=_parse_date(group["end"]))
-
-
-def add_assistants(mep, assistants):
-    # print "Assistants for " + mep.full_name.encode("Utf-8")
-    for assist_type in assistants:
-        # print "TYPE : " + assist_type.encode("Utf-8")
-        type_name = assist_type
-        for assistant in assistants[type_name]:
-            # print assistant.encode("Utf-8")
-            assistant = get_or_create(Assistant, full_name=assistant)
-            get_or_create(AssistantMEP, mep=mep, assistant=assistant, type=type_name)
-
-
-def manage_mep(mep, mep_json):
-    change_mep_details(mep, mep_json)
-    mep.committeerole_set.all().delete()
-    add_committees(mep, mep_json.get("Committees", []))
-    add_delegations(mep, mep_json.get("Delegations", []))
-    add_countries(mep, mep_json.get("Constituencies", []))
-    add_groups(mep, mep_json.get("Groups", []))
-    add_assistants(mep, mep_json.get("assistants", []))
-    if mep_json.get("Addresses"):
-        add_addrs(mep, mep_json["Addresses"])
-    add_organizations(mep, mep_json.get("Staff", []))
-    if mep_json.get("Mail"):
-        add_mep_email(mep, mep_json["Mail"])
-    mep.website_set.filter(url="").delete()
-    if mep_json.get("Homepage"):
-        add_mep_website(mep, mep_json["Homepage"] + mep_json.get("Twitter", []) + mep_json.get("Facebook", []))
-    add_mep_cv(mep, mep_json.get("CV", []))
-    # print "     save mep modifications"
-    mep.save()
-
-
-def add_missing_details(mep, mep_json):
-    mep.ep_id = int(mep_json["UserID"])
+            self.load(source, identity, options)
+
+    def shadow_import(self, source, identity, options):
+        """
+        Import into shadow copies of the tables, the live ones are only
+        replaced once the new data passed validate()
+        """
+        try:
+            shadow = ShadowTables()
+        except ShadowError as e:
+            raise CommandError(str(e))
+        with self.profiler.phase("shadow"):
+            shadow.create()
+        try:
+            with shadow.active():
+                self.load(source, identity, options)
+                with self.profiler.phase("validate"):
+                    problems = shadow.validate()
+        except:
+            shadow.drop()
+            raise
+        if problems:
+            shadow.drop()
+            raise CommandError("the imported data looks wrong, the live tables are left untouched:\n" + "\n".join(problems))
+        with self.profiler.phase("swap"):
+            shadow.swap()
+        print "swapped the imported tables in"
+
+    def load(self, source, identity, options):
+        # the shadow tables have their own copy of the checkpoint
+        self.checkpoint = checkpoint = ImportCheckpoint.objects.get_or_create(id=1)[0]
+        resume_after = None
+        if options["resume"]:
+            if checkpoint.dump != identity or checkpoint.done:
+                print "no interrupted import of this dump, import it from the beginning"
+            else:
+                resume_after = checkpoint.last_ep_id
+        checkpoint.dump, checkpoint.last_ep_id, checkpoint.done = identity, resume_after, False
+
+        self.meps = dict((mep.ep_id, mep) for mep in MEP.objects.all())
+        self.was_active = set(mep.pk for mep in self.meps.values() if mep.active)
+        self.is_active = set()
+        self.writer = BatchWriter(DimensionCache(), options["batch_size"])
+        self.added, self.changed, self.count = 0, 0, 0
+
+        print "stream and decompress", source
+        with closing(open_dump(source)) as dump:
+            records = self.profiler.iterate("parse", iter_json_array(self.profiler.reader("decompress", dump)))
+            if resume_after is not None:
+                records = self.skip_until(records, resume_after)
+            records = self.profiler.iterate("transform", iter_transform(records, options["workers"]))
+            while True:
+                with transaction.commit_on_success():
+                    imported = self.import_meps(islice(records, options["commit_every"] or None), options["force"])
+                    self.writer.flush()
+                    if self.added or self.changed:
+                        # kept until the composition is rebuilt, a rerun
+                        # after a failure skips these MEPs
+                        checkpoint.composition_stale = True
+                    checkpoint.save()
+                if not options["commit_every"] or imported < options["commit_every"]:
+                    break
 
+        with transaction.commit_on_success():
+            # MEPs that were just saved already have the right value, this
+            # only catches the skipped ones and the ones missing from the dump
+            with self.profiler.phase("active"):
+                for chunk in chunks(self.is_active - self.was_active):
+                    MEP.objects.filter(pk__in=chunk).update(active=True)
+                for chunk in chunks(self.was_active - self.is_active):
+                    MEP.objects.filter(pk__in=chunk).update(active=False)
+            prune(self.writer.cache, options["prune_dry_run"])
+            if checkpoint.composition_stale or not Composition.objects.exists():
+                with self.profiler.phase("composition"):
+                    build_composition()
+                checkpoint.composition_stale = False
+            with self.profiler.phase("offices"):
+                Office.objects.rebuild()
+            checkpoint.done = True
+            checkpoint.generation += 1
+            checkpoint.generated = timezone.now()
+            checkpoint.save()
+        print
+        print "%d added, %d changed, %d skipped" % (self.added, self.changed, self.count - self.added - self.changed)
+        print "peak memory usage: %.1f MB" % peak_memory_usage()
+
+    def skip_until(self, records, ep_id):
+        "Skip the records imported before the checkpoint, up to ep_id included"
+        for mep_json in records:
+            self.count += 1
+            if mep_json["active"] and int(mep_json["UserID"]) in self.meps:
+                self.is_active.add(self.meps[int(mep_json["UserID"])].pk)
+            if int(mep_json["UserID"]) == ep_id:
+                break
+        print "resuming after", self.count, "already imported MEPs"
+        for mep_json in records:
+            yield mep_json
+
+    def import_meps(self, records, force=False):
+        imported = 0
+        for record in records:
+            imported += 1
+            self.count += 1
+            print self.count, "-", record["name"].encode("Utf-8")
+            with self.profiler.mep(record["ep_id"], record["name"]):
+                mep = self.meps.get(record["ep_id"])
+                if mep is not None:
+                    if mep.content_hash != record["content_hash"] or force:
+                        mep.active = record["active"]
+                        mep.content_hash = record["content_hash"]
+                        manage_mep(mep, record, self.writer)
+                        self.changed += 1
+                else:
+                    mep = self.meps[record["ep_id"]] = create_mep(record, self.writer)
+                    self.added += 1
+                if record["active"]:
+                    self.is_active.add(mep.pk)
+                self.checkpoint.last_ep_id = record["ep_id"]
+            self.writer.flush_if_full()
+        return imported
+
+
+@profiled
+def add_committees(mep, committees, writer):
+    roles = []
+    for abbreviation, name, role, begin, end in committees:
+        in_db_committe = writer.cache.committees.get(abbreviation, name=name, abbreviation=abbreviation)
+        roles.append(CommitteeRole(mep=mep, committee=in_db_committe, role=role, begin=begin, end=end))
+    writer.replace(mep, CommitteeRole, roles)
+
+
+@profiled
+def add_delegations(mep, delegations, writer):
+    roles = []
+    for name, role, begin, end in delegations:
+        db_delegation = writer.cache.delegations.get(name, name=name)
+        roles.append(DelegationRole(mep=mep, delegation=db_delegation, role=role, begin=begin, end=end))
+    writer.replace(mep, DelegationRole, roles)
+
+
+@profiled
+def add_addrs(mep, addrs, writer):
+    offices, buildings, postal = addrs
+    for field, value in offices.items():
+        setattr(mep, field, value)
+    for field, (_id, name, street, postcode) in buildings.items():
+        setattr(mep, field, writer.cache.buildings.get(_id, id=_id, name=name, street=street, postcode=postcode))
+    writer.replace(mep, PostalAddress, [PostalAddress(addr=addr, mep=mep) for addr in postal])
+
+
+@profiled
+def add_countries(mep, countries, writer):
+    parties = []
+    for country_name, party_name, begin, end, current in countries:
+        _country = writer.cache.countries[country_name]
+        name = "unknown" if party_name is None else party_name
+        parties.append(writer.cache.parties.get((name, _country.id), name=name, country=_country))
+
+    country_meps = []
+    party_meps = {}
+    for party, (country_name, party_name, begin, end, current) in zip(parties, countries):
+        if party_name is not None and (party_name, party.country_id) not in party_meps:
+            party_meps[(party_name, party.country_id)] = PartyMEP(mep=mep, party=party, current=current)
+        country_meps.append(CountryMEP(mep=mep, country=writer.cache.countries[country_name], party=party, begin=begin, end=end))
+    writer.replace(mep, PartyMEP, party_meps.values())
+    writer.replace(mep, CountryMEP, country_meps)
+
+
+@profiled
+def add_organizations(mep, organizations, writer):
+    roles = []
+    for name, role, begin, end in organizations:
+        in_db_organization = writer.cache.organizations.get(name, name=name)
+        roles.append(OrganizationMEP(mep=mep, organization=in_db_organization, role=role, begin=begin, end=end))
+    writer.replace(mep, OrganizationMEP, roles)
+
+
+@profiled
+def add_groups(mep, groups, writer):
+    in_db_groups = [writer.cache.groups.get(abbreviation, abbreviation=abbreviation, name=name)
+                    for abbreviation, name, role, begin, end in groups]
+    roles = [GroupMEP(mep=mep, group=in_db_group, role=role, begin=begin, end=end)
+             for in_db_group, (abbreviation, name, role, begin, end) in zip(in_db_groups, groups)]
+    writer.replace(mep, GroupMEP, roles)
+
+
+@profiled
+def add_assistants(mep, assistants, writer):
+    assistants = [(type_name, writer.cache.assistants.get(full_name, full_name=full_name))
+                  for type_name, full_name in assistants]
+    writer.add(mep, AssistantMEP, [AssistantMEP(mep=mep, assistant=assistant, type=type_name)
+                                   for type_name, assistant in assistants])
+
+
+@profiled
+def add_mep_email(mep, emails, writer):
+    writer.add(mep, Email, [Email(mep=mep, email=email) for email in emails])
+
+
+@profiled
+def add_mep_website(mep, urls, writer):
+    writer.add(mep, WebSite, [WebSite(mep=mep, url=url) for url in urls])
+
+
+@profiled
+def add_mep_cv(mep, cv, writer):
+    writer.add(mep, CV, [CV(title=c, mep=mep) for c in cv])
+
+
+@profiled
+def change_mep_details(mep, details):
+    for field, value in details.items():
+        setattr(mep, field, value)
+
+
+def manage_mep(mep, record, writer):
+    change_mep_details(mep, record["details"])
+    add_committees(mep, record["committees"], writer)
+    add_delegations(mep, record["delegations"], writer)
+    add_countries(mep, record["countries"], writer)
+    add_groups(mep, record["groups"], writer)
+    add_assistants(mep, record["assistants"], writer)
+    if record["addrs"]:
+        add_addrs(mep, record["addrs"], writer)
+    add_organizations(mep, record["organizations"], writer)
+    add_mep_email(mep, record["emails"], writer)
+    add_mep_website(mep, record["websites"], writer)
+    add_mep_cv(mep, record["cv"], writer)
+    writer.save(mep)
 
-def create_mep(mep_json):
+
+def create_mep(record, writer):
     mep = MEP()
-    mep.active = True
-    change_mep_details(mep, mep_json)
-    add_missing_details(mep, mep_json)
-    if mep_json.get("Addresses"):
-        add_addrs(mep, mep_json["Addresses"])
-    mep.save()
-    for alias in mep_json["Name"]["aliases"]:
-        get_or_create(NameVariation, mep=mep, name=alias)
-    add_committees(mep, mep_json.get("Committees", []))
-    add_delegations(mep, mep_json.get("Delegations", []))
-    add_countries(mep, mep_json.get("Constituencies", []))
-    add_groups(mep, mep_json.get("Groups", []))
-    add_assistants(mep, mep_json.get("assistant", []))
-    add_organizations(mep, mep_json.get("Staff", []))
-    if mep_json.get("Mail"):
-        add_mep_email(mep, mep_json["Mail"])
-
-    if mep_json.get("Homepage"):
-        add_mep_website(mep, mep_json["Homepage"] + mep_json.get("Twitter", []) + mep_json.get("Facebook", []))
-    add_mep_cv(mep, mep_json.get("CV", []))
-    # print "     save mep modifications"
+    mep.active = record["active"]
+    mep.content_hash = record["content_hash"]
+    mep.ep_id = record["ep_id"]
+    change_mep_details(mep, record["details"])
+    # the relationship rows need its primary key, the rest is saved by the writer
     mep.save()
-
-
-def clean():
-    Delegation.objects.annotate(mep_count=Count('mep')).filter(mep_count=0).delete()
-    Committee.objects.annotate(mep_count=Count('mep')).filter(mep_count=0).delete()
-    Organization.objects.annotate(mep_count=Count('mep')).filter(mep_count=0).delete()
+    if record["addrs"]:
+        add_addrs(mep, record["addrs"], writer)
+    writer.add(mep, NameVariation, [NameVariation(mep=mep, name=alias) for alias in record["aliases"]])
+    add_committees(mep, record["committees"], writer)
+    add_delegations(mep, record["delegations"], writer)
+    add_countries(mep, record["countries"], writer)
+    add_groups(mep, record["groups"], writer)
+    add_assistants(mep, record["assistants"], writer)
+    add_organizations(mep, record["organizations"], writer)
+    add_mep_email(mep, record["emails"], writer)
+    add_mep_website(mep, record["websites"], writer)
+    add_mep_cv(mep, record["cv"], writer)
+    writer.save(mep)
+    return mep
+
+
+@profiled
+def prune(cache, dry_run=False):
+    """
+    Delete the dimension rows (committees, groups, parties, buildings...) no
+    MEP refers to anymore.
+
+    Only the rows the import didn't reference are candidates, so this costs
+    a few id__in queries per referencing table instead of a full join.
+    """
+    for dimension in cache.imported():
+        orphans = orphans_of(dimension.model, dimension.unreferenced())
+        if not orphans:
+            continue
+        print (u"%s %d orphan %s: %s" % ("would delete" if dry_run else "delete", len(orphans),
+                                        dimension.model.__name__,
+                                        ", ".join(unicode(pk) for pk in sorted(orphans)))).encode("Utf-8")
+        if not dry_run:
+            for chunk in chunks(orphans):
+                dimension.model.objects.filter(pk__in=chunk).delete()
+
+
+def orphans_of(model, candidates):
+    "Primary keys among candidates that no row of any other table references"
+    orphans = set(candidates)
+    for related in model._meta.get_all_related_objects():
+        field = related.field
+        for chunk in chunks(orphans):
+            orphans -= set(related.model.objects.filter(**{"%s__in" % field.attname: chunk})
+                                                .values_list(field.attname, flat=True).distinct())
+    return orphans
 
 # vim:set shiftwidth=4 tabstop=4 expandtab:
@@ -16,7 +16,9 @@
 #
 # Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
 
+import json
 from datetime import date
+from collections import OrderedDict
 from django.db import models
 from django.db.models import Count
 from django.core.urlresolvers import reverse
@@ -30,6 +32,9 @@ class TimePeriodQueryset(models.query.QuerySet):
     def newer_first(self):
         return self.order_by('-end', '-begin')
 
+    # update_meps stores the end of the open ended periods as
+    # CURRENT_MAGIC_VAL, never as NULL: these are (mep, end) and (target,
+    # begin, end) index lookups
     def only_current(self):
         return self.filter(end=CURRENT_MAGIC_VAL)
 
@@ -37,7 +42,13 @@ class TimePeriodQueryset(models.query.QuerySet):
         return self.filter(end__lt=CURRENT_MAGIC_VAL)
 
     def at_date(self, _date):
-        return self.filter(begin__lt=_date, end__gt=_date)
+        return self.filter(begin__lte=_date, end__gte=_date)
+
+
+class CompositionQueryset(TimePeriodQueryset):
+    def between(self, start, stop):
+        "Compositions in effect at some point from start to stop"
+        return self.filter(begin__lte=stop, end__gte=start)
 
 
 class TimePeriodManager(models.Manager):
@@ -59,6 +70,14 @@ class TimePeriodManager(models.Manager):
         return TimePeriodQueryset(self.model)
 
 
+class CompositionManager(TimePeriodManager):
+    def between(self, start, stop):
+        return self.get_queryset().between(start, stop)
+
+    def get_queryset(self):
+        return CompositionQueryset(self.model)
+
+
 class TimePeriod(models.Model):
     """
     Helper base class used on M2M intermediary models representing a
@@ -98,7 +117,7 @@ class Country(models.Model):
         return self.mep_set.filter(active=True).distinct()
 
     def meps_on_date(self, date):
-        return self.mep_set.filter(groupmep__end__gte=date, groupmep__begin__lte=date).distinct()
+        return MEP.objects.filter(pk__in=CountryMEP.objects.filter(country=self).at_date(date).values("mep"))
 
     class Meta:
         ordering = ["code"]
@@ -120,7 +139,7 @@ class Group(models.Model):
         return self.mep_set.filter(active=True).distinct()
 
     def meps_on_date(self, date):
-        return self.mep_set.filter(groupmep__end__gte=date, groupmep__begin__lte=date).distinct()
+        return MEP.objects.filter(pk__in=GroupMEP.objects.filter(group=self).at_date(date).values("mep"))
 
     @classmethod
     def ordered_by_meps_count(cls):
@@ -175,17 +194,15 @@ class Building(models.Model):
     def _town(self):
         return "bxl" if self.postcode == "1047" else "stg"
 
-    def floors(self):
-        floors = []
+    def directory(self):
+        "floor -> office number -> active MEPs of the building, in one query"
+        return Office.objects.directory(self).get(self, OrderedDict())
 
-        def add(x):
-            if getattr(x, "%s_floor" % self._town) not in floors:
-                floors.append(getattr(x, "%s_floor" % self._town))
-        map(add, self.meps.order_by("%s_floor" % self._town))
-        return floors
+    def floors(self):
+        return self.directory().keys()
 
     def meps(self):
-        return getattr(self, "%s_building" % self._town).filter(active=True)
+        return getattr(self, "%s_building" % self._town()).filter(active=True)
 
     def __unicode__(self):
         return u"%s - %s - %s - %s" % (self.id, self.name, self.street, self.postcode)
@@ -206,6 +223,43 @@ class Organization(models.Model):
         return self.mep_set.filter(active=True).distinct()
 
 
+class MEPQuerySet(models.query.QuerySet):
+    affiliations_date = None
+
+    def with_affiliations(self, at=None):
+        """
+        Load the groups, countries, parties, committees, delegations and
+        organizations of the MEPs in a constant number of queries. group(),
+        current_committees(), important_posts()... then answer from them
+        without any query, as of the date at (or for the running periods).
+        """
+        queryset = self.select_related("current_group", "current_country", "current_party")
+        queryset = queryset.prefetch_related("groupmep_set__group", "countrymep_set__country",
+                                             "countrymep_set__party", "committeerole_set__committee",
+                                             "delegationrole_set__delegation",
+                                             "organizationmep_set__organization")
+        queryset.affiliations_date = at
+        return queryset
+
+    def iterator(self):
+        for mep in super(MEPQuerySet, self).iterator():
+            if self.affiliations_date is not None:
+                mep.affiliations_date = self.affiliations_date
+            yield mep
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault("affiliations_date", self.affiliations_date)
+        return super(MEPQuerySet, self)._clone(klass, setup, **kwargs)
+
+
+class MEPManager(models.Manager):
+    def with_affiliations(self, at=None):
+        return self.get_queryset().with_affiliations(at)
+
+    def get_queryset(self):
+        return MEPQuerySet(self.model)
+
+
 class MEP(models.Model):
     first_name = models.CharField(max_length=255)
     last_name = models.CharField(max_length=255)
@@ -242,6 +296,16 @@ class MEP(models.Model):
     committees = models.ManyToManyField(Committee, through='CommitteeRole')
     organizations = models.ManyToManyField(Organization, through='OrganizationMEP')
     total_score = models.FloatField(default=None, null=True)
+    content_hash = models.CharField(max_length=40, null=True, editable=False)
+    # denormalized from the latest GroupMEP and CountryMEP by update_meps,
+    # see the rebuild_current_affiliations command
+    current_group = models.ForeignKey(Group, related_name="current_meps", null=True, on_delete=models.SET_NULL)
+    current_country = models.ForeignKey(Country, related_name="current_meps", null=True, on_delete=models.SET_NULL)
+    current_party = models.ForeignKey('Party', related_name="current_meps", null=True, on_delete=models.SET_NULL)
+
+    objects = MEPManager()
+    # set by MEP.objects.with_affiliations(at=...)
+    affiliations_date = None
 
     def age(self):
         if date.today().month > self.birth_date.month:
@@ -260,48 +324,99 @@ class MEP(models.Model):
     def stg_office(self):
         return self.stg_floor + self.stg_office_number
 
+    def _affiliations(self, name, current=True):
+        """
+        The <name> rows loaded by MEP.objects.with_affiliations() that are
+        current (or old, newer first) as of its date, None if they weren't
+        loaded
+        """
+        periods = getattr(self, "_prefetched_objects_cache", {}).get(name)
+        if periods is None:
+            return None
+        at = self.affiliations_date
+        if current and at is None:
+            return [period for period in periods if period.end == CURRENT_MAGIC_VAL]
+        if current:
+            return [period for period in periods if period.begin <= at <= period.end]
+        return sorted([period for period in periods if period.end < (at or CURRENT_MAGIC_VAL)],
+                      key=lambda period: period.end, reverse=True)
+
+    def _latest_affiliation(self, name):
+        "The current <name> row as of the affiliations date"
+        periods = self._affiliations(name)
+        return max(periods, key=lambda period: (period.end, period.begin)) if periods else None
+
+    # no query with select_related('current_group', 'current_country', 'current_party')
     def group(self):
-        return self.groupmep_set.select_related('group').latest('end').group if self.groupmep_set.count() else None
+        if self.affiliations_date is not None:
+            period = self._latest_affiliation("groupmep")
+            return period.group if period else None
+        return self.current_group
 
     def groupmep(self):
         return self.groupmep_set.self('group').latest('end')
 
     def country(self):
-        return self.countrymep_set.select_related('country').latest('end').country
+        if self.affiliations_date is not None:
+            period = self._latest_affiliation("countrymep")
+            return period.country if period else None
+        return self.current_country
 
     def party(self):
-        return self.countrymep_set.select_related('party').latest('end').party
+        if self.affiliations_date is not None:
+            period = self._latest_affiliation("countrymep")
+            return period.party if period else None
+        return self.current_party
+
+    # the methods below return lists instead of querysets when the MEP comes
+    # from MEP.objects.with_affiliations()
 
     def previous_mandates(self):
-        return self.countrymep_set.filter(end__isnull=False).order_by('-end')
+        mandates = self._affiliations("countrymep", current=False)
+        return self.countrymep_set.only_old().order_by('-end') if mandates is None else mandates
 
     def current_delegations(self):
-        return self.delegationrole_set.filter(end__isnull=True)
+        delegations = self._affiliations("delegationrole")
+        return self.delegationrole_set.only_current() if delegations is None else delegations
 
     def old_delegations(self):
-        return self.delegationrole_set.filter(end__isnull=False).order_by('-end')
+        delegations = self._affiliations("delegationrole", current=False)
+        return self.delegationrole_set.only_old().order_by('-end') if delegations is None else delegations
 
     def current_committees(self):
-        return self.committeerole_set.filter(end__isnull=True)
+        committees = self._affiliations("committeerole")
+        return self.committeerole_set.only_current() if committees is None else committees
 
     def old_committees(self):
-        return self.committeerole_set.filter(end__isnull=False).order_by('-end')
+        committees = self._affiliations("committeerole", current=False)
+        return self.committeerole_set.only_old().order_by('-end') if committees is None else committees
 
     def current_organizations(self):
-        return self.organizationmep_set.filter(end__isnull=True)
+        organizations = self._affiliations("organizationmep")
+        return self.organizationmep_set.only_current() if organizations is None else organizations
 
     def old_organizations(self):
-        return self.organizationmep_set.filter(end__isnull=False).order_by('-end')
+        organizations = self._affiliations("organizationmep", current=False)
+        return self.organizationmep_set.only_old().order_by('-end') if organizations is None else organizations
 
     def old_groups(self):
-        return self.groupmep_set.filter(end__isnull=False).order_by('-end')
+        groups = self._affiliations("groupmep", current=False)
+        return self.groupmep_set.only_old().order_by('-end') if groups is None else groups
 
     def important_posts(self):
-        all_roles = list(OrganizationMEP.objects.filter(mep=self).select_related('organization'))
-        for i in (GroupMEP.objects.select_related('group').exclude(role="Member").exclude(role="Substitute"), CommitteeRole.objects.select_related('committee')):
-            roles = i.filter(mep=self)
-            if roles:
-                all_roles += list(roles)
+        "Every parliament position, group position and committee role (held at the affiliations date)"
+        cache = getattr(self, "_prefetched_objects_cache", {})
+        if "organizationmep" in cache:
+            if self.affiliations_date is None:
+                periods = lambda name: list(cache[name])
+            else:
+                periods = self._affiliations
+            return (periods("organizationmep") +
+                    [group for group in periods("groupmep") if group.role not in ("Member", "Substitute")] +
+                    periods("committeerole"))
+        all_roles = list(self.organizationmep_set.select_related('organization'))
+        all_roles += list(self.groupmep_set.select_related('group').exclude(role__in=("Member", "Substitute")))
+        all_roles += list(self.committeerole_set.select_related('committee'))
         return all_roles
 
     def __unicode__(self):
@@ -327,6 +442,9 @@ class GroupMEP(TimePeriod):
     def __unicode__(self):
         return u"%s %s [%s]" % (self.mep.first_name, self.mep.last_name, self.group.abbreviation)
 
+    class Meta:
+        index_together = (("mep", "end"), ("group", "begin", "end"), ("end", "begin", "id"))
+
 
 class DelegationRole(TimePeriod):
     mep = models.ForeignKey(MEP)
@@ -339,6 +457,9 @@ class DelegationRole(TimePeriod):
     def __unicode__(self):
         return u"%s : %s" % (self.mep.full_name, self.delegation)
 
+    class Meta:
+        index_together = (("mep", "end"), ("delegation", "begin", "end"), ("end", "begin", "id"))
+
 
 class CommitteeRole(TimePeriod):
     mep = models.ForeignKey(MEP)
@@ -351,6 +472,54 @@ class CommitteeRole(TimePeriod):
     def __unicode__(self):
         return u"%s : %s" % (self.committee.abbreviation, self.mep.full_name)
 
+    class Meta:
+        index_together = (("mep", "end"), ("committee", "begin", "end"), ("end", "begin", "id"))
+
+
+class OfficeManager(models.Manager):
+    def directory(self, building=None):
+        """
+        building -> floor -> office number -> MEPs, all sorted, of every
+        building or only of building, in one query
+        """
+        offices = self.select_related("building", "mep").order_by("building", "floor", "number", "mep__last_name")
+        if building is not None:
+            offices = offices.filter(building=building)
+        directory = OrderedDict()
+        for office in offices:
+            floors = directory.setdefault(office.building, OrderedDict())
+            floors.setdefault(office.floor, OrderedDict()).setdefault(office.number, []).append(office.mep)
+        return directory
+
+    def rebuild(self):
+        "Refill the table from the Brussels and Strasbourg offices of the active MEPs"
+        offices = []
+        for mep in MEP.objects.filter(active=True).values("id", "bxl_building", "bxl_floor", "bxl_office_number",
+                                                          "stg_building", "stg_floor", "stg_office_number"):
+            for town in ("bxl", "stg"):
+                if mep["%s_building" % town]:
+                    offices.append(Office(mep_id=mep["id"], building_id=mep["%s_building" % town],
+                                          floor=mep["%s_floor" % town] or "",
+                                          number=mep["%s_office_number" % town] or ""))
+        self.all().delete()
+        self.bulk_create(offices)
+
+
+class Office(models.Model):
+    """
+    Office of an active MEP, copied from the bxl_* and stg_* fields of MEP
+    by update_meps so the directory of the buildings is one query
+    """
+    building = models.ForeignKey(Building, related_name="offices")
+    floor = models.CharField(max_length=255)
+    number = models.CharField(max_length=255)
+    mep = models.ForeignKey(MEP, related_name="offices")
+
+    objects = OfficeManager()
+
+    class Meta:
+        index_together = (("building", "floor", "number"),)
+
 
 class PostalAddress(models.Model):
     addr = models.CharField(max_length=255)
@@ -381,12 +550,18 @@ class CountryMEP(TimePeriod):
     def __unicode__(self):
         return u"%s %s - %s" % (self.mep.first_name, self.mep.last_name, self.country.code)
 
+    class Meta:
+        index_together = (("mep", "end"), ("country", "begin", "end"), ("end", "begin", "id"))
+
 
 class OrganizationMEP(TimePeriod):
     mep = models.ForeignKey(MEP)
     organization = models.ForeignKey(Organization)
     role = models.CharField(max_length=255)
 
+    class Meta:
+        index_together = (("mep", "end"), ("organization", "begin", "end"), ("end", "begin", "id"))
+
 
 class Assistant(models.Model):
     full_name = models.CharField(max_length=255)
@@ -430,3 +605,56 @@ class PartyMEP(models.Model):
     party = models.ForeignKey(Party)
     role = models.CharField(max_length=255, null=True)
     current = models.BooleanField(default=False)
+
+
+class ImportCheckpoint(models.Model):
+    """
+    Progress of the last update_meps run, committed with each chunk of
+    MEPs so an interrupted import can be resumed with --resume.
+
+    dump is the sha256 of the imported dump. generation is bumped at the
+    end of each successful import, generated being when: the API caches
+    its responses per generation. composition_stale is set once MEPs were
+    changed and until Composition is rebuilt, even by a later run.
+    """
+    dump = models.CharField(max_length=64, null=True)
+    last_ep_id = models.IntegerField(null=True)
+    done = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+    generation = models.IntegerField(default=0)
+    generated = models.DateTimeField(null=True)
+    composition_stale = models.BooleanField(default=False)
+
+
+class Composition(TimePeriod):
+    """
+    Seats of the parliament from begin to end (the next change point
+    excluded), materialized by update_meps from GroupMEP and CountryMEP so
+    the composition at a date or over a time range is one index lookup:
+
+        Composition.objects.at_date(date).get()
+        Composition.objects.between(start, stop)
+
+    groups, countries and groups_by_country are json objects of seats by
+    group abbreviation, country code and country code then group.
+    """
+    seats = models.IntegerField()
+    groups = models.TextField()
+    countries = models.TextField()
+    groups_by_country = models.TextField()
+
+    objects = CompositionManager()
+
+    class Meta:
+        ordering = ["begin"]
+        index_together = (("begin", "end"),)
+
+    def seats_by_group(self):
+        return json.loads(self.groups)
+
+    def seats_by_country(self):
+        return json.loads(self.countries)
+
+    def seats_by_group_and_country(self):
+        return json.loads(self.groups_by_country)
+
@@ -0,0 +1,117 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+"""
+Keyset pagination for the API: with ?cursor= the pages are read after the
+last row of the previous one instead of with OFFSET, and without a COUNT,
+so a deep page costs as much as the first one.
+"""
+
+import json
+import base64
+
+from django.db.models import Q
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+class KeysetPaginator(Paginator):
+    """
+    Tastypie's offset pagination, unless the request has a cursor parameter
+    (empty for the first page). The rows are then ordered by keys and each
+    page gives the cursor of the next one in meta.next, None on the last
+    page. There is no total_count and no previous page.
+    """
+    keys = ("id",)
+
+    def page(self):
+        if "cursor" not in self.request_data:
+            return super(KeysetPaginator, self).page()
+        if self.request_data.get("order_by"):
+            raise BadRequest("order_by can't be used with cursor pagination.")
+
+        limit = self.get_limit()
+        objects = self.after(self.ordered(), self.decode(self.request_data["cursor"]))
+        if limit:
+            objects = list(objects[:limit + 1])
+            objects, more = objects[:limit], len(objects) > limit
+        else:
+            objects, more = list(objects), False
+
+        meta = {"limit": limit, "next": None}
+        if more:
+            meta["next"] = self.next_uri(limit, self.encode(objects[-1]))
+        return {
+            self.collection_name: objects,
+            "meta": meta,
+        }
+
+    def ordered(self):
+        return self.objects.order_by(*self.keys)
+
+    def after(self, objects, values):
+        "The rows coming after values of the keys, all of them if values is None"
+        if values is None:
+            return objects
+        # (a, b, c) > (x, y, z) is a > x or (a = x and (b > y or (b = y and c > z)))
+        condition = None
+        for key, value in reversed(zip(self.keys, values)):
+            if condition is None:
+                condition = Q(**{"%s__gt" % key: value})
+            else:
+                condition = Q(**{"%s__gt" % key: value}) | (Q(**{key: value}) & condition)
+        # redundant, but lets the database seek the index instead of scanning it
+        return objects.filter(condition, **{"%s__gte" % self.keys[0]: values[0]})
+
+    def encode(self, obj):
+        values = [getattr(obj, key) for key in self.keys]
+        values = [value.isoformat() if hasattr(value, "isoformat") else value for value in values]
+        return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":"))).rstrip("=")
+
+    def decode(self, cursor):
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(cursor) + "=" * (-len(cursor) % 4)))
+            if not isinstance(values, list) or len(values) != len(self.keys):
+                raise ValueError
+            model = self.objects.model
+            return [model._meta.get_field(key).to_python(value) for key, value in zip(self.keys, values)]
+        except Exception:
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+    def next_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+        params = self.request_data.copy()
+        for key in ("cursor", "limit", "offset"):
+            params.pop(key, None)
+        params["limit"], params["cursor"] = limit, cursor
+        return "%s?%s" % (self.resource_uri, params.urlencode())
+
+
+class PeriodKeysetPaginator(KeysetPaginator):
+    """
+    Cursor pagination of the TimePeriod rows, in (end, begin, id) order.
+    update_meps never leaves begin or end empty, the rows that have one
+    empty are left out of the cursor pages.
+    """
+    keys = ("end", "begin", "id")
+
+    def ordered(self):
+        return super(PeriodKeysetPaginator, self).ordered().exclude(end=None).exclude(begin=None)
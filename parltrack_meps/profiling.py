@@ -0,0 +1,162 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+import time
+import resource
+from functools import wraps
+from contextlib import contextmanager
+
+SLOWEST_MEPS = 10
+
+
+def peak_memory_usage():
+    "Peak resident set size of the current process, in megabytes"
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class NullProfiler(object):
+    "Same interface as Profiler, doing nothing"
+    def phase(self, name):
+        return _nothing()
+
+    def mep(self, ep_id, name):
+        return _nothing()
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def reader(self, name, fileobj):
+        return fileobj
+
+
+@contextmanager
+def _nothing():
+    yield
+
+
+class Profiler(object):
+    """
+    Wall time and SQL queries of each phase of an import (download, parse,
+    each add_* helper...) and latency of each MEP.
+
+    Phases can be nested: the time and queries of a phase don't include the
+    ones of the phases running inside it.
+    """
+    # the profiler of the running import, used by @profiled
+    current = None
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.connection.use_debug_cursor = True
+        self.start = time.time()
+        self.phases = {}
+        self.stack = []
+        self.meps = []
+        self.forgotten_queries = 0
+
+    def queries(self):
+        return self.forgotten_queries + len(self.connection.queries)
+
+    @contextmanager
+    def phase(self, name):
+        # time and queries of the nested phases
+        self.stack.append([0., 0])
+        start, start_queries = time.time(), self.queries()
+        try:
+            yield
+        finally:
+            seconds, queries = time.time() - start, self.queries() - start_queries
+            nested_seconds, nested_queries = self.stack.pop()
+            phase = self.phases.setdefault(name, {"calls": 0, "seconds": 0., "queries": 0})
+            phase["calls"] += 1
+            phase["seconds"] += seconds - nested_seconds
+            phase["queries"] += queries - nested_queries
+            if self.stack:
+                self.stack[-1][0] += seconds
+                self.stack[-1][1] += queries
+
+    @contextmanager
+    def mep(self, ep_id, name):
+        start, start_queries = time.time(), self.queries()
+        with self.phase("mep"):
+            yield
+        self.meps.append((time.time() - start, self.queries() - start_queries, ep_id, name))
+        # connection.queries would otherwise hold every query of the import
+        self.forgotten_queries += len(self.connection.queries)
+        del self.connection.queries[:]
+
+    def iterate(self, name, iterable):
+        "Count the time spent getting each item of iterable in the phase name"
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def reader(self, name, fileobj):
+        "Wrap fileobj, counting the time spent in its read() in the phase name"
+        return _ProfiledReader(self, name, fileobj)
+
+    def report(self):
+        latencies = sorted(mep[0] for mep in self.meps)
+        percentile = lambda p: latencies[int(p * (len(latencies) - 1))] if latencies else None
+        return {
+            "seconds": time.time() - self.start,
+            "queries": self.queries(),
+            "peak_memory_mb": peak_memory_usage(),
+            "phases": self.phases,
+            "meps": {
+                "count": len(latencies),
+                "latency": {
+                    "p50": percentile(0.5),
+                    "p90": percentile(0.9),
+                    "p99": percentile(0.99),
+                    "max": percentile(1),
+                },
+                "slowest": [{"ep_id": ep_id, "name": name, "seconds": seconds, "queries": queries}
+                            for seconds, queries, ep_id, name in sorted(self.meps, reverse=True)[:SLOWEST_MEPS]],
+            },
+        }
+
+
+class _ProfiledReader(object):
+    def __init__(self, profiler, name, fileobj):
+        self.profiler = profiler
+        self.name = name
+        self.fileobj = fileobj
+
+    def read(self, *args):
+        with self.profiler.phase(self.name):
+            return self.fileobj.read(*args)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def profiled(function):
+    "Count each call to function as a phase of the import being profiled"
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if Profiler.current is None:
+            return function(*args, **kwargs)
+        with Profiler.current.phase(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
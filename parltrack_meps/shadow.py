@@ -0,0 +1,204 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+"""
+Shadow copies of the parltrack_meps tables: update_meps --shadow imports
+into them while the site and the API keep reading the live tables, then
+swaps them in with a few table renames in one transaction.
+"""
+
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import ForeignKey, get_app, get_models
+
+from parltrack_meps.models import MEP
+
+# a dump that deactivates more than this share of the active MEPs is most
+# likely broken
+MAX_ACTIVE_DROP = getattr(settings, "PARLTRACK_MEPS_SHADOW_MAX_ACTIVE_DROP", 0.1)
+
+
+class ShadowError(Exception):
+    pass
+
+
+class ShadowTables(object):
+    def __init__(self):
+        self.models = get_models(get_app("parltrack_meps"), include_auto_created=True)
+        self.check_references()
+        self.drop_order = referencing_first(self.models)
+        # SQLite keeps the index names of the shadow tables after the swap,
+        # the next import needs another token even within the same second
+        token = "%x" % int(time.time() * 1000)
+        self.live = dict((model, model._meta.db_table) for model in self.models)
+        self.shadow = dict((model, "%s_shadow%s" % (table, token)) for model, table in self.live.items())
+        self.old = dict((model, "%s_old%s" % (table, token)) for model, table in self.live.items())
+        self.live_counts = {}
+
+    def check_references(self):
+        "The live tables are dropped after the swap, nothing else may point to them"
+        for model in self.models:
+            for related in (model._meta.get_all_related_objects(include_hidden=True) +
+                            model._meta.get_all_related_many_to_many_objects()):
+                if related.model not in self.models:
+                    raise ShadowError("%s.%s references %s, its table can't be swapped" % (
+                        related.model.__name__, related.field.name, model.__name__))
+
+    @contextmanager
+    def active(self):
+        "Make the models read and write the shadow tables"
+        for model in self.models:
+            model._meta.db_table = self.shadow[model]
+        try:
+            yield
+        finally:
+            for model in self.models:
+                model._meta.db_table = self.live[model]
+
+    def create(self):
+        "Create the shadow tables as copies of the live ones"
+        self.drop_leftovers()
+        cursor = connection.cursor()
+        with transaction.commit_on_success():
+            for model in self.models:
+                self.live_counts[model] = model.objects.count()
+            self.live_active = MEP.objects.filter(active=True).count()
+
+            with self.active():
+                for statement in self.create_sql():
+                    cursor.execute(statement)
+                # referenced tables first, MySQL checks the foreign keys right away
+                for model in reversed(self.drop_order):
+                    columns = ", ".join(connection.ops.quote_name(field.column) for field in model._meta.local_fields)
+                    cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+                        connection.ops.quote_name(self.shadow[model]), columns, columns,
+                        connection.ops.quote_name(self.live[model])))
+                # the copied rows keep their ids, new ones must come after them
+                for statement in connection.ops.sequence_reset_sql(no_style(), self.models):
+                    cursor.execute(statement)
+
+    def create_sql(self):
+        "Same statements as syncdb, for the tables the models currently point to"
+        style = no_style()
+        statements, indexes = [], []
+        pending_references = {}
+        created = set()
+        for model in self.models:
+            sql, references = connection.creation.sql_create_model(model, style, created)
+            statements.extend(sql)
+            for target, fields in references.items():
+                pending_references.setdefault(target, []).extend(fields)
+                if target in created:
+                    statements.extend(connection.creation.sql_for_pending_references(target, style, pending_references))
+            statements.extend(connection.creation.sql_for_pending_references(model, style, pending_references))
+            indexes.extend(connection.creation.sql_indexes_for_model(model, style))
+            created.add(model)
+        return statements + indexes
+
+    def validate(self):
+        """
+        Return the problems of the imported data that should prevent the
+        swap, to be called while the shadow tables are active.
+        """
+        problems = []
+        cursor = connection.cursor()
+        quote = connection.ops.quote_name
+
+        active = MEP.objects.filter(active=True).count()
+        if not active:
+            problems.append("no active MEP")
+        elif self.live_active and active < self.live_active * (1 - MAX_ACTIVE_DROP):
+            problems.append("%d active MEPs instead of %d" % (active, self.live_active))
+
+        for model in self.models:
+            count = model.objects.count()
+            print "%s: %d -> %d rows" % (model.__name__, self.live_counts[model], count)
+            if count < self.live_counts[model] and model is MEP:
+                problems.append("%d MEPs instead of %d" % (count, self.live_counts[model]))
+            for field in model._meta.local_fields:
+                if not isinstance(field, ForeignKey):
+                    continue
+                target = field.rel.to
+                cursor.execute("SELECT COUNT(*) FROM %(table)s LEFT JOIN %(target)s ON %(table)s.%(column)s = %(target)s.%(target_column)s "
+                               "WHERE %(table)s.%(column)s IS NOT NULL AND %(target)s.%(target_column)s IS NULL" % {
+                                   "table": quote(model._meta.db_table),
+                                   "column": quote(field.column),
+                                   "target": quote(target._meta.db_table),
+                                   "target_column": quote(field.rel.get_related_field().column),
+                               })
+                dangling = cursor.fetchone()[0]
+                if dangling:
+                    problems.append("%d %s rows with a missing %s" % (dangling, model.__name__, field.name))
+        return problems
+
+    def swap(self):
+        "Replace the live tables by the shadow ones, then drop the previous ones"
+        cursor = connection.cursor()
+        with transaction.commit_on_success():
+            for model in self.models:
+                self.rename(cursor, self.live[model], self.old[model])
+            for model in self.models:
+                self.rename(cursor, self.shadow[model], self.live[model])
+        self.drop(self.old)
+
+    def rename(self, cursor, table, new_name):
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (connection.ops.quote_name(table), connection.ops.quote_name(new_name)))
+
+    def drop(self, tables=None):
+        "Drop the shadow tables (or tables, a model -> table dict) if they exist"
+        tables = self.shadow if tables is None else tables
+        existing = connection.introspection.table_names()
+        cursor = connection.cursor()
+        with transaction.commit_on_success():
+            for model in self.drop_order:
+                if tables.get(model) in existing:
+                    cursor.execute("DROP TABLE %s" % connection.ops.quote_name(tables[model]))
+
+    def drop_leftovers(self):
+        "Drop the shadow and old tables an interrupted import left behind"
+        leftovers = {}
+        for table in connection.introspection.table_names():
+            for model in self.models:
+                if table.startswith(self.live[model] + "_shadow") or table.startswith(self.live[model] + "_old"):
+                    leftovers.setdefault(model, []).append(table)
+        while leftovers:
+            self.drop(dict((model, tables.pop()) for model, tables in leftovers.items()))
+            leftovers = dict((model, tables) for model, tables in leftovers.items() if tables)
+
+
+def referencing_first(models):
+    """
+    models ordered so that each one comes before the models its foreign
+    keys point to, the order their tables can be dropped in.
+    """
+    remaining = list(models)
+    ordered = []
+    while remaining:
+        referenced = set(field.rel.to for model in remaining for field in model._meta.local_fields
+                         if isinstance(field, ForeignKey) and field.rel.to is not model)
+        unreferenced = [model for model in remaining if model not in referenced]
+        if not unreferenced:
+            raise ShadowError("circular foreign keys between %s, their tables can't be swapped" %
+                              ", ".join(model.__name__ for model in remaining))
+        ordered.extend(unreferenced)
+        remaining = [model for model in remaining if model in referenced]
+    return ordered
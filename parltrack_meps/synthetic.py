@@ -0,0 +1,253 @@
+# encoding: utf-8
+
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+"""
+Synthetic parltrack dumps, shaped like ep_meps_current.json, to measure
+update_meps offline.
+
+The same count and seed always give the same MEPs, and churn() derives a
+later version of a dump where a given share of the MEPs changed.
+"""
+
+import gzip
+import json
+import random
+from copy import deepcopy
+
+from parltrack_meps.dump import lzma
+
+TERM_START = "2009-07-14T00:00:00"
+PREVIOUS_TERM_START = "2004-07-20T00:00:00"
+PREVIOUS_TERM_END = "2009-07-13T00:00:00"
+OPEN_END = "9999-12-31T00:00:00"
+CHURN_DATE = "2012-01-18T00:00:00"
+
+COUNTRIES = ("Austria", "Belgium", "Bulgaria", "Cyprus", "Czech Republic", "Germany", "Denmark",
+             "Estonia", "Spain", "Finland", "France", "United Kingdom", "Greece", "Hungary",
+             "Ireland", "Italy", "Lithuania", "Luxembourg", "Latvia", "Malta", "Netherlands",
+             "Poland", "Portugal", "Romania", "Sweden", "Slovenia", "Slovakia")
+
+# groupid as parltrack writes them, including the ones update_meps converts
+GROUPS = (
+    ("PPE", "Group of the European People's Party (Christian Democrats)"),
+    ("S&D", "Group of the Progressive Alliance of Socialists and Democrats in the European Parliament"),
+    ("ALDE", "Group of the Alliance of Liberals and Democrats for Europe"),
+    ("Verts/ALE", "Group of the Greens/European Free Alliance"),
+    ("ECR", "European Conservatives and Reformists"),
+    ("GUE/NGL", "Confederal Group of the European United Left - Nordic Green Left"),
+    ("EFD", "Europe of freedom and democracy Group"),
+    (["NA", "NI"], "Non-attached Members"),
+)
+
+COMMITTEES = (
+    ("AFET", "Committee on Foreign Affairs"),
+    ("DEVE", "Committee on Development"),
+    ("INTA", "Committee on International Trade"),
+    ("BUDG", "Committee on Budgets"),
+    ("CONT", "Committee on Budgetary Control"),
+    ("ECON", "Committee on Economic and Monetary Affairs"),
+    ("EMPL", "Committee on Employment and Social Affairs"),
+    ("ENVI", "Committee on the Environment, Public Health and Food Safety"),
+    ("ITRE", "Committee on Industry, Research and Energy"),
+    ("IMCO", "Committee on the Internal Market and Consumer Protection"),
+    ("TRAN", "Committee on Transport and Tourism"),
+    ("REGI", "Committee on Regional Development"),
+    ("AGRI", "Committee on Agriculture and Rural Development"),
+    ("PECH", "Committee on Fisheries"),
+    ("CULT", "Committee on Culture and Education"),
+    ("JURI", "Committee on Legal Affairs"),
+    ("LIBE", "Committee on Civil Liberties, Justice and Home Affairs"),
+    ("AFCO", "Committee on Constitutional Affairs"),
+    ("FEMM", "Committee on Women's Rights and Gender Equality"),
+    ("PETI", "Committee on Petitions"),
+)
+
+DELEGATIONS = ["Delegation for relations with %s" % country for country in
+               ("the United States", "Japan", "China", "India", "Canada", "Russia", "Switzerland",
+                "Norway", "Israel", "Palestine", "the Mashreq countries", "the Maghreb countries",
+                "Australia and New Zealand", "South Africa", "Mercosur", "the Andean Community",
+                "Central America", "the Korean Peninsula", "Iran", "Iraq", "Afghanistan",
+                "the Arab Peninsula", "the countries of South Asia", "Belarus", "Ukraine")]
+
+ROLES = ("Member", "Member", "Member", "Substitute", "Substitute", "Vice-Chair", "Chair")
+STAFF = ("President", "Vice-President", "Quaestor", "Member of the Bureau")
+ASSISTANT_TYPES = ("accredited", "local", "service")
+FIRST_NAMES = (u"Anna", u"Jean", u"Maria", u"Peter", u"José", u"Eva", u"Jan", u"Sophie", u"Luca", u"Zoë")
+BXL_BUILDINGS = (("ASP", "Altiero Spinelli"), ("PHS", "Paul-Henri Spaak"), ("WIB", "Willy Brandt"))
+STG_BUILDINGS = (("LOW", "Louise Weiss"), ("WIC", "Winston Churchill"))
+
+
+def generate_meps(count, seed=0, committees=3, delegations=2, groups=1, constituencies=1,
+                  assistants=4, staff=0.05, previous_term=0.3, addresses=True):
+    """
+    Return count synthetic parltrack records.
+
+    committees, delegations, constituencies and assistants are the average
+    number of each per MEP, groups the number of group memberships of each
+    MEP, staff and previous_term the share of MEPs with a parliament
+    position or with a mandate during the previous term.
+    """
+    generator = random.Random(seed)
+    return [_mep(generator, 1000 + i, committees, delegations, groups, constituencies,
+                 assistants, staff, previous_term, addresses)
+            for i in range(count)]
+
+
+def _around(generator, mean):
+    "A count around mean, so the MEPs don't all look the same"
+    return max(0, int(round(generator.uniform(mean * 0.5, mean * 1.5))))
+
+
+def _period(generator, extra, current=True):
+    period = {"role": generator.choice(ROLES), "start": TERM_START}
+    if current:
+        period["end"] = OPEN_END
+    else:
+        period["start"], period["end"] = PREVIOUS_TERM_START, PREVIOUS_TERM_END
+    period.update(extra)
+    return period
+
+
+def _mep(generator, ep_id, committees, delegations, groups, constituencies, assistants, staff,
+         previous_term, addresses):
+    first_name = generator.choice(FIRST_NAMES)
+    family = u"NAME%d" % ep_id
+    country = generator.choice(COUNTRIES)
+    party = u"%s party %d" % (country, generator.randint(1, 8))
+    previous = generator.random() < previous_term
+
+    mep = {
+        "UserID": ep_id,
+        "active": True,
+        "Name": {"full": u"%s %s" % (first_name, family), "sur": first_name, "family": family,
+                 "aliases": [u"%s %s" % (first_name.lower(), family.lower()), family.lower()]},
+        "Birth": {"date": "%04d-%02d-%02dT00:00:00" % (generator.randint(1940, 1985),
+                                                       generator.randint(1, 12), generator.randint(1, 28)),
+                  "place": u"Town %d" % generator.randint(1, 500)},
+        "Gender": generator.choice(("M", "F", "n/a")),
+        "Mail": [u"%s.%s@europarl.europa.eu" % (first_name.lower(), family.lower())],
+        "Homepage": [u"http://www.example.eu/%d" % ep_id],
+        "Twitter": [u"http://twitter.com/mep%d" % ep_id],
+        "CV": [u"CV line %d of MEP %d" % (i, ep_id) for i in range(generator.randint(0, 5))],
+    }
+
+    mep["Committees"] = [_period(generator, {"committee_id": abbreviation, "Organization": name})
+                         for abbreviation, name in generator.sample(COMMITTEES, min(len(COMMITTEES), _around(generator, committees)))]
+    mep["Delegations"] = [_period(generator, {"Organization": name})
+                          for name in generator.sample(DELEGATIONS, min(len(DELEGATIONS), _around(generator, delegations)))]
+    mep["Groups"] = []
+    for groupid, name in generator.sample(GROUPS, min(len(GROUPS), groups)):
+        mep["Groups"].append(_period(generator, {"groupid": groupid, "Organization": name, "role": "Member"}))
+    mep["Constituencies"] = [{"country": country, "party": party, "start": TERM_START, "end": OPEN_END}
+                             for _ in range(max(1, _around(generator, constituencies)))]
+    if previous:
+        mep["Constituencies"].append({"country": country, "party": party,
+                                      "start": PREVIOUS_TERM_START, "end": PREVIOUS_TERM_END})
+        mep["Groups"].append(_period(generator, {"groupid": mep["Groups"][0]["groupid"] if mep["Groups"] else "ECR",
+                                                 "Organization": mep["Groups"][0]["Organization"] if mep["Groups"] else GROUPS[4][1],
+                                                 "role": "Member"}, current=False))
+    mep["Staff"] = [_period(generator, {"Organization": "European Parliament", "role": generator.choice(STAFF)})
+                    ] if generator.random() < staff else []
+
+    mep["assistants"] = {}
+    for i in range(_around(generator, assistants)):
+        type_name = ASSISTANT_TYPES[i % len(ASSISTANT_TYPES)]
+        # assistants are shared by a few MEPs
+        mep["assistants"].setdefault(type_name, []).append(u"ASSISTANT %d" % generator.randint(1, 3000))
+
+    if addresses:
+        bxl_code, bxl_name = generator.choice(BXL_BUILDINGS)
+        stg_code, stg_name = generator.choice(STG_BUILDINGS)
+        phone = generator.randint(10000, 99999)
+        mep["Addresses"] = {
+            "Brussels": {"Address": {"building_code": bxl_code, "Building": bxl_name, "Street": "60, rue Wiertz",
+                                     "Zip": "1047", "Office": "%02dG%03d" % (generator.randint(1, 15), generator.randint(1, 400))},
+                         "Phone": "+32(0)2 28 %05d" % phone, "Fax": "+32(0)2 28 4%04d" % (phone % 10000)},
+            "Strasbourg": {"Address": {"building_code": stg_code, "Building": stg_name,
+                                       "Street": u"1, avenue du Président Robert Schuman - CS 91024",
+                                       "Zip1": "67070", "Office": "T%02d%03d" % (generator.randint(1, 12), generator.randint(1, 400))},
+                           "Phone": "+33(0)3 88 1%04d" % (phone % 10000)},
+            "Postal": [u"European Parliament", u"Bât. %s %05d" % (bxl_name, phone), u"60, rue Wiertz", u"B-1047 Brussels"],
+        }
+    return mep
+
+
+def churn(meps, rate, seed=0):
+    """
+    Return a copy of meps where about rate (0 to 1) of the MEPs changed the
+    way they do between two parltrack dumps: a new committee role, a group
+    switch, a new assistant, a new office or leaving the parliament.
+    """
+    generator = random.Random(seed)
+    meps = deepcopy(meps)
+    for mep in generator.sample(meps, int(round(len(meps) * rate))):
+        generator.choice((_new_committee, _switch_group, _new_assistant, _move_office, _leave))(generator, mep)
+    return meps
+
+
+def _close_current(periods):
+    for period in periods:
+        if period.get("end") == OPEN_END:
+            period["end"] = CHURN_DATE
+
+
+def _new_committee(generator, mep):
+    abbreviation, name = generator.choice(COMMITTEES)
+    mep["Committees"] = [period for period in mep["Committees"] if period["committee_id"] != abbreviation]
+    mep["Committees"].append(_period(generator, {"committee_id": abbreviation, "Organization": name,
+                                                 "start": CHURN_DATE}))
+
+
+def _switch_group(generator, mep):
+    groupid, name = generator.choice(GROUPS)
+    _close_current(mep["Groups"])
+    mep["Groups"].append(_period(generator, {"groupid": groupid, "Organization": name, "role": "Member",
+                                             "start": CHURN_DATE}))
+
+
+def _new_assistant(generator, mep):
+    mep["assistants"].setdefault("accredited", []).append(u"ASSISTANT %d" % generator.randint(3001, 4000))
+
+
+def _move_office(generator, mep):
+    if mep.get("Addresses"):
+        mep["Addresses"]["Brussels"]["Address"]["Office"] = "%02dG%03d" % (generator.randint(1, 15), generator.randint(1, 400))
+    else:
+        _new_assistant(generator, mep)
+
+
+def _leave(generator, mep):
+    mep["active"] = False
+    for periods in ("Committees", "Delegations", "Groups", "Staff"):
+        _close_current(mep[periods])
+
+
+def write_dump(meps, path, indent=None):
+    "Write meps as a parltrack dump, compressed if path ends with .xz or .gz"
+    if path.endswith(".xz"):
+        if lzma is None:
+            raise Exception("lzma module missing, please install backports.lzma")
+        output = lzma.LZMAFile(path, "wb")
+    elif path.endswith(".gz"):
+        output = gzip.GzipFile(path, "wb")
+    else:
+        output = open(path, "wb")
+    with output:
+        json.dump(meps, output, indent=indent)
@@ -0,0 +1,299 @@
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import BaseHTTPServer
+from datetime import date
+from StringIO import StringIO
+from unittest import skipUnless
+
+from django.conf.urls import patterns, include, url
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from tastypie.api import Api
+
+from parltrack_meps import api
+from parltrack_meps.dump import fetch_dump
+from parltrack_meps.shadow import ShadowTables
+from parltrack_meps.models import (CURRENT_MAGIC_VAL, MEP, Group, GroupMEP, Committee, CommitteeRole,
+                                   Country, Party, CountryMEP, Delegation, DelegationRole,
+                                   Organization, OrganizationMEP, Building, PostalAddress,
+                                   ImportCheckpoint)
+
+# resource -> queries of a list page, whatever its size
+API_QUERIES = (
+    (api.MEPMEPResource, 8),
+    (api.MEPCountryResource, 4),
+    (api.MEPLocalPartyResource, 4),
+    (api.MEPGroupResource, 4),
+    (api.MEPDelegationResource, 4),
+    (api.MEPCommitteeResource, 4),
+    (api.MEPOrganizationResource, 4),
+    (api.MEPBuildingResource, 3),
+    (api.MEPGroupMEPResource, 3),
+    (api.MEPDelegationRoleResource, 3),
+    (api.MEPCommitteeRoleResource, 3),
+    (api.MEPPostalAddressResource, 3),
+    (api.MEPCountryMEPResource, 3),
+    (api.MEPOrganizationMEPResource, 3),
+)
+
+v1 = Api(api_name="v1")
+for resource, queries in API_QUERIES:
+    v1.register(resource())
+urlpatterns = patterns("", url(r"^api/", include(v1.urls)))
+
+
+def create_mep(ep_id):
+    return MEP.objects.create(first_name="Jane", last_name="DOE%d" % ep_id,
+                              last_name_with_prefix="DOE%d" % ep_id, ep_id=ep_id)
+
+
+def call_quietly(name, *args, **options):
+    "call_command() returning what the command printed"
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        call_command(name, *args, **options)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+def sqlite_indexes(model):
+    "columns -> name of the indexes of the table of model"
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA index_list("%s")' % model._meta.db_table)
+    indexes = {}
+    for name in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('PRAGMA index_info("%s")' % name)
+        indexes[tuple(row[2] for row in cursor.fetchall())] = name
+    return indexes
+
+
+def sqlite_query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return "\n".join(row[-1] for row in cursor.fetchall())
+
+
+class AtDateTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(abbreviation="TST", name="Test group")
+        mep = create_mep(1)
+        self.old = GroupMEP.objects.create(mep=mep, group=self.group, role="Member",
+                                           begin=date(2009, 7, 14), end=date(2014, 6, 30))
+        self.current = GroupMEP.objects.create(mep=mep, group=self.group, role="Chair",
+                                               begin=date(2014, 7, 1), end=CURRENT_MAGIC_VAL)
+
+    def at_date(self, day):
+        return list(GroupMEP.objects.filter(group=self.group).at_date(day).order_by("begin"))
+
+    def test_bounds_are_inclusive(self):
+        self.assertEqual(self.at_date(date(2009, 7, 14)), [self.old])
+        self.assertEqual(self.at_date(date(2014, 6, 30)), [self.old])
+        self.assertEqual(self.at_date(date(2014, 7, 1)), [self.current])
+
+    def test_outside_of_the_periods(self):
+        self.assertEqual(self.at_date(date(2009, 7, 13)), [])
+
+    def test_open_ended_period(self):
+        self.assertEqual(self.at_date(date(2030, 1, 1)), [self.current])
+        self.assertEqual(list(GroupMEP.objects.only_current()), [self.current])
+        self.assertEqual(list(GroupMEP.objects.only_old()), [self.old])
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are checked on SQLite")
+class PeriodIndexesTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(abbreviation="TST", name="Test group")
+        committee = Committee.objects.create(abbreviation="TST", name="Test committee")
+        self.mep = create_mep(1)
+        for ep_id in range(2, 12):
+            mep = create_mep(ep_id)
+            GroupMEP.objects.create(mep=mep, group=self.group, role="Member",
+                                    begin=date(2009, 7, 14), end=CURRENT_MAGIC_VAL)
+            CommitteeRole.objects.create(mep=mep, committee=committee, role="Member",
+                                         begin=date(2009, 7, 14), end=CURRENT_MAGIC_VAL)
+
+    def assertUsesIndex(self, queryset, model, columns):
+        plan = sqlite_query_plan(queryset)
+        self.assertIn("INDEX %s " % sqlite_indexes(model)[columns], plan)
+
+    def test_at_date_uses_the_target_begin_end_index(self):
+        self.assertUsesIndex(GroupMEP.objects.filter(group=self.group).at_date(date(2012, 1, 1)),
+                             GroupMEP, ("group_id", "begin", "end"))
+
+    def test_only_current_uses_the_mep_end_index(self):
+        self.assertUsesIndex(self.mep.committeerole_set.only_current(),
+                             CommitteeRole, ("mep_id", "end"))
+
+
+class APIQueriesTest(TestCase):
+    urls = "parltrack_meps.tests"
+
+    def setUp(self):
+        # the responses are cached per import generation
+        cache.clear()
+        begin = date(2009, 7, 14)
+        country = Country.objects.create(code="ZZ", name="Testland")
+        for number in range(60):
+            mep = create_mep(number + 1)
+            mep.bxl_building = Building.objects.create(id="B%d" % number, name="Building", street="", postcode="1047")
+            mep.stg_building = Building.objects.create(id="S%d" % number, name="Building", street="", postcode="67070")
+            mep.save()
+            party = Party.objects.create(name="Party %d" % number, country=country)
+            GroupMEP.objects.create(mep=mep, group=Group.objects.create(abbreviation="G%d" % number, name="Group %d" % number),
+                                    role="Member", begin=begin, end=CURRENT_MAGIC_VAL)
+            CountryMEP.objects.create(mep=mep, country=country, party=party, begin=begin, end=CURRENT_MAGIC_VAL)
+            CommitteeRole.objects.create(mep=mep, committee=Committee.objects.create(abbreviation="C%d" % number, name="Committee %d" % number),
+                                         role="Member", begin=begin, end=CURRENT_MAGIC_VAL)
+            DelegationRole.objects.create(mep=mep, delegation=Delegation.objects.create(name="Delegation %d" % number),
+                                          role="Member", begin=begin, end=CURRENT_MAGIC_VAL)
+            OrganizationMEP.objects.create(mep=mep, organization=Organization.objects.create(name="Organization %d" % number),
+                                           role="Member", begin=begin, end=CURRENT_MAGIC_VAL)
+            PostalAddress.objects.create(mep=mep, addr="Rue %d" % number)
+
+    def test_list_queries_dont_depend_on_the_page_size(self):
+        for resource, queries in API_QUERIES:
+            for limit in (5, 50):
+                url = "/api/v1/%s/?format=json&limit=%d" % (resource._meta.resource_name, limit)
+                with self.assertNumQueries(queries):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200, url)
+
+
+class DumpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves body with etag, or a 304 when the request has a matching
+    If-None-Match. length overrides the Content-Length to fake an
+    interrupted download.
+    """
+    body = "[]"
+    etag = '"1"'
+    length = None
+
+    def do_GET(self):
+        self.requests.append(self.headers.getheader("If-None-Match"))
+        if self.headers.getheader("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(self.body) if self.length is None else self.length))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchDumpTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        class Handler(DumpHandler):
+            requests = []
+        self.handler = Handler
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), self.handler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = "http://127.0.0.1:%d/ep_meps_current.json" % self.server.server_port
+        self.path = os.path.join(self.cache_dir, "ep_meps_current.json")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def serve(self, body, etag, length=None):
+        self.handler.body, self.handler.etag, self.handler.length = body, etag, length
+
+    def cached(self):
+        with open(self.path) as dump:
+            return dump.read()
+
+    def test_unchanged_dump_is_not_downloaded_again(self):
+        self.assertEqual(fetch_dump(self.url, self.cache_dir), (self.path, hashlib.sha256("[]").hexdigest()))
+        self.assertEqual(fetch_dump(self.url, self.cache_dir), (self.path, hashlib.sha256("[]").hexdigest()))
+        self.assertEqual(self.handler.requests, [None, '"1"'])
+        self.assertEqual(self.cached(), "[]")
+
+    def test_same_dump_with_another_etag_isnt_imported_again(self):
+        path, sha256 = fetch_dump(self.url, self.cache_dir)
+        ImportCheckpoint.objects.create(id=1, dump=sha256, done=True, generation=1)
+        self.serve("[]", '"2"')
+        output = call_quietly("update_meps", source=self.url, cache_dir=self.cache_dir)
+        self.assertEqual(self.handler.requests, [None, '"1"'])
+        self.assertIn("nothing to do", output)
+        self.assertEqual(ImportCheckpoint.objects.get().generation, 1)
+
+    def test_interrupted_download_keeps_the_previous_dump(self):
+        fetch_dump(self.url, self.cache_dir)
+        self.serve('[{"UserID": 1}]', '"2"', length=100)
+        self.assertRaises(IOError, fetch_dump, self.url, self.cache_dir)
+        self.assertEqual(self.cached(), "[]")
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+        self.serve('[{"UserID": 1}]', '"2"')
+        self.assertEqual(fetch_dump(self.url, self.cache_dir)[1], hashlib.sha256('[{"UserID": 1}]').hexdigest())
+        self.assertEqual(self.cached(), '[{"UserID": 1}]')
+
+    def test_leftover_part_file_is_overwritten(self):
+        with open(self.path + ".part", "w") as part:
+            part.write("garbage from a crashed download")
+        fetch_dump(self.url, self.cache_dir)
+        self.assertEqual(self.cached(), "[]")
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+
+class ShadowImportTest(TransactionTestCase):
+    def setUp(self):
+        self.dump_dir = tempfile.mkdtemp()
+        self.dump = os.path.join(self.dump_dir, "meps.json")
+        call_quietly("generate_meps_dump", self.dump, meps=20)
+        if connection.vendor == "sqlite":
+            # like PostgreSQL and MySQL, refuse to drop referenced rows
+            connection.cursor().execute("PRAGMA foreign_keys = ON")
+
+    def tearDown(self):
+        if connection.vendor == "sqlite":
+            connection.cursor().execute("PRAGMA foreign_keys = OFF")
+        shutil.rmtree(self.dump_dir)
+
+    def test_tables_are_dropped_before_the_ones_they_reference(self):
+        drop_order = ShadowTables().drop_order
+        for position, model in enumerate(drop_order):
+            for field in model._meta.local_fields:
+                if field.rel is not None and field.rel.to is not model:
+                    self.assertGreater(drop_order.index(field.rel.to), position,
+                                       "%s.%s" % (model.__name__, field.name))
+
+    def test_import_twice(self):
+        for run in range(2):
+            call_quietly("update_meps", source=self.dump, shadow=True, force=True)
+            self.assertEqual(MEP.objects.count(), 20)
+            self.assertEqual(MEP.objects.exclude(current_party=None).count(), 20)
+        tables = connection.introspection.table_names()
+        self.assertEqual([table for table in tables if "_shadow" in table or "_old" in table], [])
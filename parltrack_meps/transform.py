@@ -0,0 +1,317 @@
+# encoding: utf-8
+
+# This file is part of django-parltrack-meps.
+#
+# django-parltrack-meps is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of
+# the License, or any later version.
+#
+# django-parltrack-meps is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU General Affero Public
+# License along with Foobar.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2013  Laurent Peuch <cortex@worlddomination.be>
+
+"""
+Turn raw parltrack records into the plain values (dicts, tuples, dates)
+update_meps writes in the database.
+
+Nothing here touches the database, so records can be transformed in worker
+processes while the command writes the previous ones.
+"""
+
+import json
+import hashlib
+from datetime import datetime
+from itertools import islice
+from operator import itemgetter
+from collections import deque
+from multiprocessing import Pool
+
+TRANSFORM_CHUNK_SIZE = 20
+# part of the hash of the records: bump it when update_meps starts storing
+# something new, so the next import writes it for the MEPs that didn't change
+# too (2: current group, country and party)
+TRANSFORM_VERSION = 2
+DATE_FORMAT = "%Y-%m-%dT00:%H:00"
+# end of the periods still running, models.CURRENT_MAGIC_VAL
+OPEN_END = "9999-12-31T00:00:00"
+
+FIX_LAST_NAME_WITH_PREFIX = {
+    "Esther de LANGE": "de LANGE",
+    "Patricia van der KAMMEN": "van der KAMMEN",
+    "Judith A. MERKIES": "MERKIES",
+    "Heinz K. BECKER": "BECKER",
+    "Cornelis de JONG": "de JONG",
+    "Peter van DALEN": "van DALEN",
+    "Sophia in 't VELD": "in 't VELD",
+    "Marielle de SARNEZ": "de SARNEZ",
+    "Anne E. JENSEN": "JENSEN",
+    "Wim van de CAMP": "van de CAMP",
+    "Lambert van NISTELROOIJ": "van NISTELROOIJ",
+    "Johannes Cornelis van BAALEN": "van BAALEN",
+    "Ioannis A. TSOUKALAS": "TSOUKALAS",
+    "Pilar del CASTILLO VERA": "del CASTILLO VERA",
+    "Luis de GRANDES PASCUAL": "de GRANDES PASCUAL",
+    "Philippe de VILLIERS": "de VILLIERS",
+    "Daniël van der STOEP": "van der STOEP",
+    "William (The Earl of) DARTMOUTH": "(The Earl of) Dartmouth",
+    "Bairbre de BRÚN": u'de Br\xfan',
+    "Karl von WOGAU": u'von WOGAU',
+    "Ieke van den BURG": u'van den BURG',
+    "Manuel António dos SANTOS": u'dos SANTOS',
+    "Paul van BUITENEN": u'van BUITENEN',
+    "Elly de GROEN-KOUWENHOVEN": u'de GROEN-KOUWENHOVEN',
+    "Margrietus van den BERG": u'van den BERG',
+    u'Dani\xebl van der STOEP': u'van der STOEP',
+    "Alexander Graf LAMBSDORFF": u'Graf LAMBSDORFF',
+    u'Bairbre de BR\xdaN': u'de BR\xdaN',
+    'Luigi de MAGISTRIS': 'de MAGISTRIS',
+}
+
+GROUP_ABBREVIATIONS = {"S&D": "SD", "NA": "NI", "ID": "IND/DEM", "PPE": "EPP", "Verts/ALE": "Greens/EFA"}
+
+_dates = {}
+
+
+def parse_date(string):
+    """
+    Parse a parltrack date. A dump only holds a few thousand distinct dates
+    (term boundaries...), each one is parsed once and the same datetime
+    object is returned for all its occurrences.
+    """
+    try:
+        return _dates[string]
+    except KeyError:
+        date = _dates[string] = datetime.strptime(string, DATE_FORMAT)
+        return date
+
+
+def parse_end(period):
+    "End of a parltrack period, OPEN_END if it has none so they all look the same"
+    return parse_date(period.get("end") or OPEN_END)
+
+
+def compile_columns(columns):
+    """
+    Compile a declarative list of columns into a function returning the
+    tuple of their values for a parltrack dict.
+
+    Each column is a key of the dict, a (key, converter) pair or a function
+    of the whole dict.
+    """
+    if len(columns) > 1 and all(isinstance(column, basestring) for column in columns):
+        # only plain keys, itemgetter builds the whole tuple
+        return itemgetter(*columns)
+
+    getters = []
+    for column in columns:
+        if callable(column):
+            getters.append(column)
+        elif isinstance(column, tuple):
+            getters.append(_converted(itemgetter(column[0]), column[1]))
+        else:
+            getters.append(itemgetter(column))
+    return lambda item: tuple([get(item) for get in getters])
+
+
+def _converted(get, converter):
+    return lambda item: converter(get(item))
+
+
+def compile_rows(source, columns, required=None):
+    """
+    Compile the mapping of the source list of a parltrack record
+    (Committees, Groups...) into a function returning the row tuples of a
+    record. Items without a value for required are skipped.
+    """
+    row = compile_columns(columns)
+
+    def rows(record):
+        return [row(item) for item in record.get(source) or []
+                if item and (required is None or item.get(required))]
+    return rows
+
+
+def _group_abbreviation(groupid):
+    if type(groupid) is list:
+        # I really don't like that hack
+        groupid = groupid[0]
+    return GROUP_ABBREVIATIONS.get(groupid, groupid)
+
+
+def record_hash(mep_json):
+    """
+    Stable hash of a parltrack record and of TRANSFORM_VERSION, used to skip
+    the MEPs that didn't change
+    """
+    record = json.dumps(mep_json, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1("%d:%s" % (TRANSFORM_VERSION, record)).hexdigest()
+
+
+# (first name, last name) from the Name of a record
+_names = compile_columns(("sur", "family"))
+
+
+def transform_details(mep_json):
+    "MEP columns, only the ones the record has a value for"
+    details = {}
+    if mep_json.get("Birth"):
+        details["birth_date"] = parse_date(mep_json["Birth"]["date"])
+        if "place" in mep_json["Birth"]:
+            details["birth_place"] = mep_json["Birth"]["place"]
+    first_name, last_name = _names(mep_json["Name"])
+    details["first_name"] = first_name
+    details["last_name"] = last_name
+    details["full_name"] = "%s %s" % (first_name, last_name)
+
+    if FIX_LAST_NAME_WITH_PREFIX.get(details["full_name"]):
+        details["last_name_with_prefix"] = FIX_LAST_NAME_WITH_PREFIX[details["full_name"]]
+    elif last_name == "J.A.J. STASSEN":
+        details["last_name_with_prefix"] = "STASSEN"
+    else:
+        details["last_name_with_prefix"] = last_name
+
+    details["swaped_name"] = "%s %s" % (last_name, first_name)
+
+    if mep_json.get("Gender", u'n/a') == u'n/a':
+        details["gender"] = None
+    else:
+        details["gender"] = mep_json["Gender"]
+    return details
+
+
+def transform_addrs(addrs):
+    """
+    Returns the office columns of the MEP, its buildings as (id, name,
+    street, postcode) and its postal addresses
+    """
+    offices = {}
+    buildings = {}
+    if addrs.get("Brussels"):
+        bxl = addrs["Brussels"]
+        if bxl["Address"].get("building_code"):
+            buildings["bxl_building"] = (bxl["Address"]["building_code"],
+                                         bxl["Address"]["Building"],
+                                         bxl["Address"]["Street"],
+                                         bxl["Address"]["Zip"])
+        offices["bxl_floor"] = bxl["Address"]["Office"][:2]
+        offices["bxl_office_number"] = bxl["Address"]["Office"][2:]
+        offices["bxl_fax"] = bxl.get("Fax")
+        offices["bxl_phone1"] = bxl["Phone"]
+        offices["bxl_phone2"] = bxl["Phone"][:-4] + "7" + bxl["Phone"][-3:]
+    if addrs.get("Strasbourg"):
+        stg = addrs["Strasbourg"]
+        if stg["Address"].get("building_code"):
+            buildings["stg_building"] = (stg["Address"]["building_code"],
+                                         stg["Address"]["Building"],
+                                         stg["Address"]["Street"],
+                                         stg["Address"].get("Zip", stg["Address"]["Zip1"]))
+        offices["stg_floor"] = stg["Address"]["Office"][:3]
+        offices["stg_office_number"] = stg["Address"]["Office"][3:]
+        offices["stg_fax"] = stg.get("Fax")
+        offices["stg_phone1"] = stg.get("Phone")
+        if stg.get("Phone"):
+            offices["stg_phone2"] = stg["Phone"][:-4] + "7" + stg["Phone"][-3:]
+    return offices, buildings, addrs.get("Postal", [])
+
+
+# FIXME create or how abbreviations ? Or are they really important ? or create a new class ?
+# (abbreviation, name, role, begin, end) of each committee role
+transform_committees = compile_rows("Committees", ("committee_id", "Organization", "role",
+                                                   ("start", parse_date), parse_end),
+                                    required="committee_id")
+
+# (name, role, begin, end) of each delegation role
+transform_delegations = compile_rows("Delegations", ("Organization", "role",
+                                                     ("start", parse_date), parse_end))
+
+# (country, party or None, begin, end, current) of each mandate
+#current = True if parse_date(country["end"]).year > date.today().year else False
+transform_countries = compile_rows("Constituencies", ("country", lambda country: country.get("party"),
+                                                      ("start", parse_date), parse_end,
+                                                      lambda country: 'end' not in country))
+
+# (abbreviation, name, role, begin, end) of each group membership
+transform_groups = compile_rows("Groups", (("groupid", _group_abbreviation), "Organization", "role",
+                                           ("start", parse_date), parse_end),
+                                required="groupid")
+
+# (name, role, begin, end) of each organization role
+transform_organizations = compile_rows("Staff", ("Organization", "role",
+                                                 ("start", parse_date), parse_end))
+
+
+def transform_assistants(assistants):
+    "(type, full name) of each assistant"
+    return [(type_name, full_name)
+            for type_name in assistants
+            for full_name in assistants[type_name]]
+
+
+def transform(mep_json):
+    "Everything update_meps needs to know about a MEP, as plain values"
+    emails = mep_json.get("Mail") or []
+    if not isinstance(emails, list):
+        emails = [emails]
+    websites = []
+    if mep_json.get("Homepage"):
+        websites = mep_json["Homepage"] + mep_json.get("Twitter", []) + mep_json.get("Facebook", [])
+
+    return {
+        "ep_id": int(mep_json["UserID"]),
+        "name": mep_json["Name"]["full"],
+        "active": mep_json["active"],
+        "content_hash": record_hash(mep_json),
+        "details": transform_details(mep_json),
+        "aliases": mep_json["Name"]["aliases"],
+        "addrs": transform_addrs(mep_json["Addresses"]) if mep_json.get("Addresses") else None,
+        "committees": transform_committees(mep_json),
+        "delegations": transform_delegations(mep_json),
+        "countries": transform_countries(mep_json),
+        "groups": transform_groups(mep_json),
+        "organizations": transform_organizations(mep_json),
+        "assistants": transform_assistants(mep_json.get("assistants", [])),
+        "emails": emails,
+        "websites": websites,
+        "cv": [c for c in mep_json.get("CV", []) if c],
+    }
+
+
+def transform_many(records):
+    return map(transform, records)
+
+
+def iter_transform(records, workers=1):
+    """
+    Yield transform(record) for each record, in order.
+
+    With more than one worker the records are transformed by a pool of
+    processes, a bounded number of chunks at a time so memory stays flat.
+    """
+    if workers <= 1:
+        for record in records:
+            yield transform(record)
+        return
+
+    records = iter(records)
+    pool = Pool(workers)
+    try:
+        pending = deque()
+        while True:
+            chunk = list(islice(records, TRANSFORM_CHUNK_SIZE))
+            if chunk:
+                pending.append(pool.apply_async(transform_many, (chunk,)))
+            if pending and (not chunk or len(pending) > 2 * workers):
+                for row in pending.popleft().get():
+                    yield row
+            elif not chunk:
+                break
+    finally:
+        pool.terminate()